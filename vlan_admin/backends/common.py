@@ -1,21 +1,428 @@
+import bisect
 import collections
+import concurrent.futures
+import contextlib
+import re
+import threading
 from urwid import MetaSignals, emit_signal
 import time
 
+from ..counters import COUNTERS, PortCounters, format_bits
+from ..log import flush_deferred
+
 
 class CommitException(Exception):
     pass
 
 
+class RequestTotals(object):
+    """
+    Accumulated timing information for a group of requests (e.g. all
+    requests of a given operation, or to a given target).
+    """
+
+    # Upper bounds (in seconds) of the duration histogram buckets. An
+    # extra bucket at the end catches anything slower.
+    buckets = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.bytes = 0
+        self.retries = 0
+        self.duration = 0.0
+        self.max_duration = 0.0
+        self.histogram = [0] * (len(self.buckets) + 1)
+
+    def add(self, duration, nbytes, retries, failed):
+        self.count += 1
+        self.failed += bool(failed)
+        self.bytes += nbytes
+        self.retries += retries
+        self.duration += duration
+        self.max_duration = max(self.max_duration, duration)
+
+        bucket = 0
+        while bucket < len(self.buckets) and duration > self.buckets[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'failed': self.failed,
+            'bytes': self.bytes,
+            'retries': self.retries,
+            'duration': self.duration,
+            'max_duration': self.max_duration,
+            'histogram': dict(zip([str(b) for b in self.buckets] + ['inf'], self.histogram)),
+        }
+
+    def histogram_str(self):
+        """
+        Returns the non-empty histogram buckets as a compact string.
+        """
+        labels = ['<%gms' % (b * 1000) for b in self.buckets] + ['>%gms' % (self.buckets[-1] * 1000)]
+        return ' '.join('%s:%d' % (l, n) for l, n in zip(labels, self.histogram) if n)
+
+    def __str__(self):
+        avg = self.duration / self.count if self.count else 0
+        return '%d requests, %.3fs total, %.1fms avg, %.1fms max, %d bytes, %d retries, %d failed' % (
+            self.count, self.duration, avg * 1000, self.max_duration * 1000,
+            self.bytes, self.retries, self.failed)
+
+
+class Request(object):
+    """
+    A single request in progress, as returned by RequestStats.measure.
+    The backend should fill in bytes and retries before the request
+    completes, duration is filled in when it completes.
+    """
+    def __init__(self, op, target):
+        self.op = op
+        self.target = target
+        self.bytes = 0
+        self.retries = 0
+        self.duration = None
+
+
+class RequestStats(object):
+    """
+    Collects timing information about all requests a backend sends to
+    its switch during a session. Requests are grouped by operation (e.g.
+    GET, WALK, SET or POST) and by (operation, target), where the target
+    is the OID or URL path involved.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.total = RequestTotals()
+        self.ops = collections.defaultdict(RequestTotals)
+        self.targets = collections.defaultdict(RequestTotals)
+        # Requests can be made from multiple threads during a
+        # concurrent commit
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def measure(self, op, target):
+        """
+        Context manager that times the request made inside it. Yields a
+        Request object, on which the number of bytes transferred and
+        retries can be set.
+        """
+        request = Request(op, target)
+        failed = True
+        start = time.perf_counter()
+        try:
+            yield request
+            failed = False
+        finally:
+            request.duration = time.perf_counter() - start
+            self.record(op, target, request.duration, request.bytes, request.retries, failed)
+
+    def record(self, op, target, duration, nbytes=0, retries=0, failed=False):
+        with self.lock:
+            self.total.add(duration, nbytes, retries, failed)
+            self.ops[op].add(duration, nbytes, retries, failed)
+            self.targets[(op, target)].add(duration, nbytes, retries, failed)
+
+    def slowest_targets(self, count):
+        """
+        Returns the count (op, target) groups with the highest total
+        duration, as (op, target, totals) tuples.
+        """
+        items = sorted(self.targets.items(), key=lambda i: i[1].duration, reverse=True)
+        return [(op, target, totals) for ((op, target), totals) in items[:count]]
+
+    def summary(self, slowest=10):
+        """
+        Returns a list of lines summarizing the statistics, for display.
+        """
+        lines = ['Total: %s' % self.total]
+        for op, totals in sorted(self.ops.items()):
+            lines.append('%s: %s' % (op, totals))
+            lines.append('  %s' % totals.histogram_str())
+        if self.targets:
+            lines.append('')
+            lines.append('Slowest targets:')
+            for op, target, totals in self.slowest_targets(slowest):
+                lines.append('%s %s: %s' % (op, target, totals))
+        return lines
+
+    def as_dict(self):
+        return {
+            'started': self.started,
+            'total': self.total.as_dict(),
+            'ops': {op: totals.as_dict() for op, totals in self.ops.items()},
+            'targets': [
+                dict(op=op, target=target, **totals.as_dict())
+                for (op, target), totals in self.targets.items()
+            ],
+        }
+
+
+class CommitStep(object):
+    """
+    A single backend call in a CommitPlan: a commit_* method name with
+    its arguments and a human readable description.
+
+    keys lists the things (e.g. ('vlan', dotq_id) or ('port', num))
+    this step touches. Steps sharing a key are always executed in plan
+    order, other steps can be executed concurrently.
+    """
+    def __init__(self, description, keys, method, *args):
+        self.description = description
+        self.keys = keys
+        self.method = method
+        self.args = args
+
+    def __str__(self):
+        return self.description
+
+
+class CommitPlan(object):
+    """
+    An ordered list of CommitSteps that commit the pending changes of a
+    switch, as returned by Switch.plan_commit().
+    """
+    def __init__(self, switch):
+        self.switch = switch
+        self.steps = []
+
+    def add(self, description, keys, method, *args):
+        self.steps.append(CommitStep(description, keys, method, *args))
+
+    @property
+    def requests(self):
+        """
+        The number of requests this plan is expected to need.
+        """
+        return sum(self.switch.commit_requests(step) for step in self.steps)
+
+    def summary(self):
+        """
+        Returns a list of lines describing this plan, for display.
+        """
+        lines = ['%d. %s' % (i + 1, step) for i, step in enumerate(self.steps)]
+        lines.append('')
+        lines.append('%d steps, about %d requests' % (len(self.steps), self.requests))
+        return lines
+
+    def run(self, step):
+        getattr(self.switch, step.method)(*step.args)
+
+    def execute(self, concurrency=1):
+        """
+        Execute all steps. With a concurrency above one, steps that do
+        not depend on each other are run in worker threads, with at
+        most concurrency steps in flight at the same time.
+        """
+        if concurrency <= 1:
+            for step in self.steps:
+                self.run(step)
+            return
+
+        # Each step depends on the last earlier step sharing a key with
+        # it. Since steps sharing a key form a chain, this is enough
+        # to keep all of them in order.
+        last = {}
+        waiting_for = {}
+        dependents = collections.defaultdict(list)
+        for step in self.steps:
+            waiting_for[step] = {last[key] for key in step.keys if key in last}
+            for dependency in waiting_for[step]:
+                dependents[dependency].append(step)
+            for key in step.keys:
+                last[key] = step
+
+        ready = collections.deque(step for step in self.steps if not waiting_for[step])
+        running = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+                while ready or running:
+                    while ready and len(running) < concurrency:
+                        step = ready.popleft()
+                        running[executor.submit(self.run, step)] = step
+
+                    # Wake up regularly to show status and log messages
+                    # from the workers
+                    done, _ = concurrent.futures.wait(
+                        running, timeout=0.1, return_when=concurrent.futures.FIRST_COMPLETED)
+                    self.switch.deliver_deferred_signals()
+                    flush_deferred()
+
+                    for future in done:
+                        step = running.pop(future)
+                        # Raises any exception from the step, which
+                        # stops submitting new steps (but lets the
+                        # running ones finish)
+                        future.result()
+                        for dependent in dependents[step]:
+                            waiting_for[dependent].discard(step)
+                            if not waiting_for[dependent]:
+                                ready.append(dependent)
+        finally:
+            self.switch.deliver_deferred_signals()
+            flush_deferred()
+
+
+class MacTable(object):
+    """
+    Index of the forwarding database of a switch, mapping MAC addresses
+    to the vlans and (bridge) ports they were seen on.
+
+    MAC addresses are stored as 12 lowercase hex digits, but lookups
+    accept any of the usual notations (e.g. 00:11:22:aa:bb:cc,
+    00-11-22-AA-BB-CC or 0011.22aa.bbcc).
+    """
+    def __init__(self):
+        # Maps MAC to a list of (vlan id, port number) tuples. The vlan
+        # id is None when it cannot be determined.
+        self.entries = {}
+        self._sorted = None
+
+    @staticmethod
+    def normalize(mac):
+        return re.sub('[-:. ]', '', mac).lower()
+
+    @staticmethod
+    def format(mac):
+        return ':'.join(mac[i:i + 2] for i in range(0, len(mac), 2))
+
+    def add(self, mac, vlan_id, port_num):
+        self.entries.setdefault(self.normalize(mac), []).append((vlan_id, port_num))
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, mac):
+        """
+        Returns a list of (vlan id, port number) for the given MAC.
+        """
+        return self.entries.get(self.normalize(mac), [])
+
+    def search(self, prefix):
+        """
+        Returns a sorted list of (MAC, vlan id, port number) tuples for
+        all MACs starting with the given prefix.
+        """
+        if self._sorted is None:
+            self._sorted = sorted(self.entries)
+
+        prefix = self.normalize(prefix)
+        result = []
+        for i in range(bisect.bisect_left(self._sorted, prefix), len(self._sorted)):
+            mac = self._sorted[i]
+            if not mac.startswith(prefix):
+                break
+            result.extend((mac, vlan_id, port_num) for vlan_id, port_num in self.entries[mac])
+        return result
+
+    def port_counts(self):
+        """
+        Returns a dict mapping port numbers to the number of MACs seen
+        on them.
+        """
+        counts = collections.Counter()
+        for entries in self.entries.values():
+            counts.update({port_num for vlan_id, port_num in entries})
+        return counts
+
+
+class UndoHistory(object):
+    """
+    Undo and redo stacks of actions, each a tuple of records, one for
+    every change queued by the action. Records refer to ports and vlans
+    by number and 802.1q id (which stay valid when vlans are deleted
+    and added again), see Switch.encode_change().
+
+    At most depth actions are kept on each stack, older ones are
+    forgotten.
+    """
+    def __init__(self, depth):
+        self.undo_stack = collections.deque(maxlen=depth)
+        self.redo_stack = collections.deque(maxlen=depth)
+        # Records of the action in progress
+        self.current = []
+        # Disabled while undoing and redoing
+        self.recording = True
+
+    def record(self, record):
+        self.current.append(record)
+        self.redo_stack.clear()
+
+    def end_action(self):
+        """
+        Finish the current action, so the changes made after this are
+        undone separately.
+        """
+        if self.current:
+            self.undo_stack.append(tuple(self.current))
+            self.current = []
+
+    def clear(self):
+        """
+        Forget all actions, e.g. after they were committed (undoing
+        them would then revert the switch configuration).
+        """
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.current = []
+
+
 class Switch(metaclass=MetaSignals):
     signals = ['changelist_changed', 'details_changed', 'portlist_changed', 'vlanlist_changed', 'status_changed']
 
+    # How many commit steps to run at the same time. Backends that can
+    # handle concurrent requests can increase this.
+    commit_concurrency = 1
+
+    # Whether get_link_status() is implemented (and cheap enough to
+    # call periodically)
+    supports_link_polling = False
+
+    # Whether get_mac_table() is implemented
+    supports_mac_table = False
+
+    # Whether get_counters() is implemented
+    supports_counters = False
+
+    # Whether get_lldp_neighbors() is implemented
+    supports_lldp = False
+
     def __init__(self, config):
         self.ports = []
         self.vlans = []
         self.dotq_vlans = {}
         self.config = config
         self.changes = []
+        # Timing info for all requests sent to the switch. Backends
+        # should send every request through self.stats.measure()
+        self.stats = RequestStats()
+        # Result of the last get_mac_table(), once applied
+        self.mac_table = None
+        # Number of counter samples to keep for each port
+        self.counter_history = int(config.get('counter_history', 120))
+        # Rates need two samples, see PortCounters.rates()
+        if self.counter_history < 2:
+            raise ValueError("%s: counter_history must be at least 2" % config.name)
+        # Signals emitted by worker threads, see _emit()
+        self._deferred_signals = collections.deque()
+        # When True, signals emitted by the main thread are coalesced
+        # until deliver_deferred_signals() is called, see _coalesce().
+        # The interface sets this and delivers them once per main loop
+        # iteration, so a burst of changes updates each widget once.
+        self.coalesce_signals = False
+        # Signals coalesced so far, mapping (object, name) to arguments
+        self._pending_signals = {}
+        # Nesting depth of batch(), and the changes it collected
+        self._batch_depth = 0
+        self._batch_changes = []
+        self.history = UndoHistory(int(config.get('undo_depth', 100)))
+        # Journal of queued changes, see journal.Journal
+        self.journal = None
+        # Cassette recording or replaying all requests, see exchange()
+        self.cassette = None
 
         for column in self.switch_attrs:
             for (label_text, attr, edit) in column:
@@ -27,8 +434,93 @@ class Switch(metaclass=MetaSignals):
         """
         Convenience function to emit signals with self as first
         argument.
+
+        urwid is not thread-safe, so signals emitted by worker threads
+        (e.g. status updates during a concurrent commit) are only
+        delivered when the main thread calls deliver_deferred_signals().
+        """
+        if threading.current_thread() is not threading.main_thread():
+            self._deferred_signals.append((name, args))
+        elif not self._coalesce(self, name, args):
+            emit_signal(self, name, self, *args)
+
+    def deliver_deferred_signals(self):
+        """
+        Deliver the signals emitted by worker threads, and those
+        coalesced because of coalesce_signals. Must be called from the
+        main thread.
+        """
+        while self._deferred_signals:
+            name, args = self._deferred_signals.popleft()
+            emit_signal(self, name, self, *args)
+
+        # Signals coalesced by a batch() are delivered when it ends
+        if self._batch_depth:
+            return
+
+        # Handlers can emit new signals, deliver those as well
+        while self._pending_signals:
+            signals, self._pending_signals = self._pending_signals, {}
+            for (obj, name), args in signals.items():
+                emit_signal(obj, name, obj, *args)
+
+    @contextlib.contextmanager
+    def batch(self):
         """
-        emit_signal(self, name, self, *args)
+        Context manager to make many changes at once, e.g.:
+
+            with switch.batch():
+                for vlan in vlans:
+                    for port in ports:
+                        vlan.set_port_membership(port, Vlan.TAGGED)
+
+        Changes made inside the block are merged into the changelist in
+        a single pass at the end, instead of one pass per change.
+        Signals are coalesced (see _coalesce()) and emitted at the end,
+        or with coalesce_signals set, when deliver_deferred_signals() is
+        called.
+
+        Batches can be nested, only the outermost one has effect. The
+        outermost one is undone as a single action.
+        """
+        if not self._batch_depth:
+            self.history.end_action()
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            if self._batch_depth == 1:
+                # Merge while still inside the batch, so the
+                # changelist_changed signal is coalesced as well
+                changes, self._batch_changes = self._batch_changes, []
+                self._merge_changes(changes)
+            self._batch_depth -= 1
+            if not self._batch_depth:
+                self.history.end_action()
+                if not self.coalesce_signals:
+                    self.deliver_deferred_signals()
+
+    def _coalesce(self, obj, name, args):
+        """
+        Called for signals emitted by obj (this switch or one of its
+        ports or vlans). Inside a batch() or when coalesce_signals is
+        set, remember the signal to be emitted later and return True.
+        Otherwise, return False.
+
+        Each signal is emitted once for each object that emitted it,
+        with the arguments of the last emission. When the arguments
+        differ (e.g. memberships_changed for different ports of a vlan),
+        all arguments are None instead, meaning "anything might have
+        changed".
+        """
+        # Status messages are meant to be shown right away
+        if not (self._batch_depth or self.coalesce_signals) or name == 'status_changed':
+            return False
+        key = (obj, name)
+        if key in self._pending_signals and self._pending_signals[key] != args:
+            args = (None,) * len(args)
+        self._pending_signals[key] = args
+        return True
 
     def add_vlan(self, dotq_id):
         vlan = Vlan(self, None, dotq_id, '')
@@ -51,7 +543,195 @@ class Switch(metaclass=MetaSignals):
 
         self._emit('vlanlist_changed')
 
+    def apply_changes(self, changes):
+        """
+        Apply the given changes (e.g. from snapshot.diff()) to this
+        switch, queueing them like changes made in the interface, so
+        they can be reviewed and committed with commit_all(). Ports and
+        vlans are looked up by number, so the changes can also come
+        from another switch.
+        """
+        ports = {port.num: port for port in self.ports}
+        with self.batch():
+            for change in changes:
+                if isinstance(change, AddVlanChange):
+                    if change.what.dotq_id not in self.dotq_vlans:
+                        self.add_vlan(change.what.dotq_id)
+                elif isinstance(change, DeleteVlanChange):
+                    if change.what.dotq_id in self.dotq_vlans:
+                        self.delete_vlan(self.dotq_vlans[change.what.dotq_id])
+                elif isinstance(change, VlanNameChange):
+                    self.dotq_vlans[change.what.dotq_id].name = change.how
+                elif isinstance(change, PortVlanMembershipChange):
+                    self.dotq_vlans[change.vlan.dotq_id].set_port_membership(ports[change.port.num], change.how)
+                elif isinstance(change, PortDescriptionChange):
+                    ports[change.what.num].description = change.how
+                elif isinstance(change, PortPVIDChange):
+                    ports[change.what.num].pvid = change.how
+                else:
+                    assert False, "Unknown change type? (%s)" % (type(change))
+
+    def _merge_changes(self, new_changes):
+        """
+        Merge a list of changes into the changelist, like calling
+        queue_change() for each of them, but in a single pass. This
+        does not support adding or removing vlans.
+        """
+        if not new_changes:
+            return
+
+        # These changes only merge with an earlier change of the same
+        # type for the same port or vlan, of which there is at most
+        # one, so that can be looked up in a dict. Merged away
+        # changes are replaced by None and filtered out at the end.
+        changes = list(self.changes)
+        index = {(type(c), c.what): i for i, c in enumerate(changes)}
+        for new_change in new_changes:
+            key = (type(new_change), new_change.what)
+            if key in index:
+                i = index[key]
+                (new_change, replacement) = new_change.merge_with(changes[i])
+                if replacement:
+                    (changes[i],) = replacement
+                else:
+                    changes[i] = None
+                    del index[key]
+            if new_change:
+                index[key] = len(changes)
+                changes.append(new_change)
+
+        self.changes = [c for c in changes if c is not None]
+        self._emit('changelist_changed')
+
+    def encode_change(self, change):
+        """
+        Returns a compact record of the given change for the undo
+        history: a tuple of the change type, the port number and/or
+        vlan id, and the new and old values. For removed vlans, their
+        name and memberships (one byte per port) are kept instead.
+        """
+        if isinstance(change, PortVlanMembershipChange):
+            return (PortVlanMembershipChange, change.port.num, change.vlan.dotq_id, change.how, change.old)
+        elif isinstance(change, (PortPVIDChange, PortDescriptionChange)):
+            return (type(change), change.what.num, change.how, change.old)
+        elif isinstance(change, VlanNameChange):
+            return (VlanNameChange, change.what.dotq_id, change.how, change.old)
+        elif isinstance(change, AddVlanChange):
+            return (AddVlanChange, change.what.dotq_id)
+        elif isinstance(change, DeleteVlanChange):
+            vlan = change.what
+            return (DeleteVlanChange, vlan.dotq_id, vlan.name, bytes(vlan.ports[port] for port in self.ports))
+        else:
+            assert False, "Unknown change type? (%s)" % (type(change))
+
+    def undo(self):
+        """
+        Undo the last action (everything changed since the previous
+        call to UndoHistory.end_action(), or a batch), by queueing the
+        inverse of its changes as a single batch. Returns False when
+        there is nothing to undo.
+        """
+        self.history.end_action()
+        if not self.history.undo_stack:
+            return False
+        action = self.history.undo_stack.pop()
+        self._replay(reversed(action), undo=True)
+        self.history.redo_stack.append(action)
+        return True
+
+    def redo(self):
+        """
+        Redo the last action undone. Returns False when there is
+        nothing to redo.
+        """
+        if self.history.current or not self.history.redo_stack:
+            return False
+        action = self.history.redo_stack.pop()
+        self._replay(action, undo=False)
+        self.history.undo_stack.append(action)
+        return True
+
+    def _replay(self, records, undo):
+        with self.batch():
+            self.history.recording = False
+            try:
+                for record in records:
+                    self.apply_record(record, undo)
+            finally:
+                self.history.recording = True
+
+    def apply_record(self, record, undo=False):
+        """
+        Queue the change described by the given record (see
+        encode_change()), or its inverse when undo is True.
+        """
+        ports = {port.num: port for port in self.ports}
+        kind = record[0]
+        if kind is AddVlanChange or kind is DeleteVlanChange:
+            dotq_id = record[1]
+            if (kind is AddVlanChange) != undo:
+                self.add_vlan(dotq_id)
+            else:
+                self.delete_vlan(self.dotq_vlans[dotq_id])
+
+            if kind is DeleteVlanChange and undo:
+                # Restore the removed vlan
+                vlan = self.dotq_vlans[dotq_id]
+                vlan.name = record[2]
+                for port, membership in zip(self.ports, record[3]):
+                    if membership != Vlan.NOTMEMBER:
+                        vlan.ports[port] = membership
+                        self.queue_change(PortVlanMembershipChange((port, vlan), membership, Vlan.NOTMEMBER))
+            return
+
+        how, old = record[-2:]
+        if undo:
+            how, old = old, how
+
+        # The state is changed directly (rather than through the
+        # setters), since any changes the setters would make as a
+        # consequence (e.g. of making a port untagged) are part of the
+        # recorded action already.
+        if kind is PortVlanMembershipChange:
+            port, vlan = ports[record[1]], self.dotq_vlans[record[2]]
+            vlan.ports[port] = how
+            self.queue_change(PortVlanMembershipChange((port, vlan), how, old))
+            vlan._emit('memberships_changed', port, how)
+        elif kind is PortPVIDChange:
+            port = ports[record[1]]
+            port._pvid = how
+            self.queue_change(PortPVIDChange(port, how, old))
+            port._emit('details_changed')
+        elif kind is PortDescriptionChange:
+            port = ports[record[1]]
+            port._description = how
+            self.queue_change(PortDescriptionChange(port, how, old))
+            port._emit('details_changed')
+        elif kind is VlanNameChange:
+            vlan = self.dotq_vlans[record[1]]
+            vlan._name = how
+            self.queue_change(VlanNameChange(vlan, how, old))
+            vlan._emit('details_changed')
+
     def queue_change(self, new_change):
+        if self.history.recording or self.journal:
+            record = self.encode_change(new_change)
+            if self.history.recording:
+                self.history.record(record)
+            if self.journal:
+                self.journal.append(record)
+
+        if self._batch_depth:
+            if isinstance(new_change, (AddVlanChange, DeleteVlanChange)):
+                # These merge with changes queued before them (which
+                # also depends on the memberships of the vlan at this
+                # point), so merge everything queued so far now
+                changes, self._batch_changes = self._batch_changes, []
+                self._merge_changes(changes)
+            else:
+                self._batch_changes.append(new_change)
+                return
+
         # Make a new changes list to prevent issues with inline
         # modification (while looping the list)
         new_changes = []
@@ -80,6 +760,17 @@ class Switch(metaclass=MetaSignals):
         # Always call this, just in case something changed
         self._emit('changelist_changed')
 
+    def exchange(self, kind, key, fn):
+        """
+        Do a request by calling fn(), returning its result. Backends
+        should send every request through this, so it can be recorded
+        or replayed when a cassette is set (see cassette.Cassette.call()
+        for the meaning of kind and key).
+        """
+        if self.cassette is None:
+            return fn()
+        return self.cassette.call(kind, key, fn)
+
     def do_login(self):
         # Default to no login needed
         pass
@@ -88,9 +779,10 @@ class Switch(metaclass=MetaSignals):
         # Default to no logout needed
         pass
 
-    def commit_all(self):
+    def plan_commit(self):
         """
-        Commit all pending changes.
+        Compile all pending changes into a CommitPlan, listing the
+        backend calls needed to commit them, in order.
 
         This method decides the order in which to commit changes. This
         order was originally written for the FS726T, which is a bit
@@ -98,14 +790,7 @@ class Switch(metaclass=MetaSignals):
         port is member of), but this order probably works well with
         other switches too.
         """
-
-        def changes_of_type(type):
-            return [c for c in self.changes if isinstance(c, type)]
-
-        if not self.changes:
-            raise CommitException("No changes to commit")
-
-        self._emit('status_changed', "Committing changes...")
+        plan = CommitPlan(self)
 
         # Maps a vlan to a dict that maps port to (newvalue, oldvalue)
         # tuples. Undefined elements default to the empty dict.
@@ -117,15 +802,25 @@ class Switch(metaclass=MetaSignals):
         first_pass = collections.defaultdict(list)
         second_pass = collections.defaultdict(list)
 
-        # Keep a list of vlans to delete
+        # Ports whose PVID changes, and the dotq_ids of their old and
+        # new PVIDs
+        pvid_ports = []
+        pvid_vlans = set()
+
+        # Keep a list of vlans to add and delete
+        add_vlans = []
         delete_vlans = []
 
         for change in self.changes:
             if isinstance(change, PortDescriptionChange):
-                self.commit_port_description_change(change.what, change.how)
+                plan.add("Set port %d description to: %s" % (change.what.num, change.how),
+                         [('port', change.what.num)], 'commit_port_description_change', change.what, change.how)
             elif isinstance(change, VlanNameChange):
-                self.commit_vlan_description_change(change.what, change.how)
+                plan.add("Set vlan %d name to: %s" % (change.what.dotq_id, change.how),
+                         [('vlan', change.what.dotq_id)], 'commit_vlan_description_change', change.what, change.how)
             elif isinstance(change, PortPVIDChange):
+                pvid_ports.append(change.what)
+                pvid_vlans.update((change.how, change.old))
                 # This port must be added to the vlan new PVID in the
                 # first pass (before setting the PVIDs)
                 first_pass[self.dotq_vlans[change.how]].append(change.what)
@@ -137,7 +832,9 @@ class Switch(metaclass=MetaSignals):
             elif isinstance(change, PortVlanMembershipChange):
                 memberships[change.vlan][change.port] = (change.how, change.old)
             elif isinstance(change, AddVlanChange):
-                self.commit_vlan_add(change.what)
+                plan.add("Create vlan %d" % change.what.dotq_id, [('vlan', change.what.dotq_id)],
+                         'commit_vlan_add', change.what)
+                add_vlans.append(change.what)
                 # Make sure that the vlan has an entry in memberships,
                 # even if no ports need changing.
                 memberships[change.what]
@@ -146,10 +843,16 @@ class Switch(metaclass=MetaSignals):
             else:
                 assert False, "Unknown change type? (%s)" % (type(change))
 
+        # Maps a vlan to the list of memberships currently on the
+        # switch, to detect writes that would not change anything. New
+        # vlans are never in here, so they are always written (the
+        # FS726T creates vlans by writing their memberships).
+        on_switch = {}
+
         def commit_memberships(vlan, ports):
             """
-            Helper function to commit the changes in the given vlan (for
-            the given ports only).
+            Helper function to plan committing the changes in the given
+            vlan (for the given ports only).
             """
             changes = memberships[vlan]
             changelist = []
@@ -169,7 +872,21 @@ class Switch(metaclass=MetaSignals):
                         # Commit the new value
                         changelist.append(new)
 
-            self.commit_vlan_memberships(vlan, changelist)
+            if vlan not in on_switch and vlan not in add_vlans:
+                on_switch[vlan] = [changes[p][1] if p in changes else vlan.ports[p] for p in self.ports]
+
+            old = on_switch.get(vlan)
+            if changelist == old:
+                # Nothing would change, so skip the write entirely
+                return
+            on_switch[vlan] = changelist
+
+            if old is None:
+                changed = [p for p, m in zip(self.ports, changelist) if m != Vlan.NOTMEMBER]
+            else:
+                changed = [p for p, m, o in zip(self.ports, changelist, old) if m != o]
+            plan.add("Set vlan %d memberships (ports %s)" % (vlan.dotq_id, ', '.join(str(p.num) for p in changed)),
+                     [('vlan', vlan.dotq_id)], 'commit_vlan_memberships', vlan, changelist)
 
         # Committing vlan memberships happens in two passes: First, we
         # commit all vlan/port combinations that have to happen before
@@ -183,10 +900,11 @@ class Switch(metaclass=MetaSignals):
         # its PVID).
         for vlan, ports in first_pass.items():
             if vlan in second_pass:
-                # If we run this vlan again in the second pass, just
-                # commit the ports that really need to be before the
-                # PVID changes
-                commit_memberships(vlan, ports)
+                # If we run this vlan again in the second pass, commit
+                # everything except the ports that really need to wait
+                # until after the PVID changes. This leaves only those
+                # for the second pass.
+                commit_memberships(vlan, [p for p in self.ports if p not in second_pass[vlan]])
             else:
                 # If we don't need to run this vlan again in the second
                 # pass, just commit all ports.
@@ -194,11 +912,14 @@ class Switch(metaclass=MetaSignals):
                 del memberships[vlan]
 
         # If any pvids should be changed, commit the current (new)
-        # values of all PVIDs. No need to actually look at the
-        # PortPVIDChange objects generated, since we can only set all of
-        # the PVIDs in a single request.
-        if first_pass or second_pass:
-            self.commit_pvids([p.pvid for p in self.ports])
+        # values of all PVIDs. Backends that can only set all PVIDs at
+        # once can ignore the list of changed ports.
+        if pvid_ports:
+            # All vlans involved in PVID changes must be written in
+            # plan order relative to this step
+            keys = [('pvids',)] + [('vlan', dotq_id) for dotq_id in pvid_vlans]
+            plan.add("Set PVIDs (ports %s)" % ', '.join(str(p.num) for p in pvid_ports),
+                     keys, 'commit_pvids', [p.pvid for p in self.ports], pvid_ports)
 
         # And now, the second pass, just commit any remaining changes
         for vlan in memberships:
@@ -210,9 +931,26 @@ class Switch(metaclass=MetaSignals):
         # internal_ids, so it's a lot easier to do them all in go an
         # then renumber the remaining vlans.
         for vlan in delete_vlans:
-            self.commit_vlan_delete(vlan)
+            plan.add("Delete vlan %d" % vlan.dotq_id, [('vlan', vlan.dotq_id)], 'commit_vlan_delete', vlan)
+
+        return plan
+
+    def commit_all(self):
+        """
+        Commit all pending changes, by executing the plan returned by
+        plan_commit().
+        """
+        if not self.changes:
+            raise CommitException("No changes to commit")
+
+        plan = self.plan_commit()
+
+        self._emit('status_changed', "Committing changes...")
+
+        plan.execute(self.commit_concurrency)
 
         self.changes = []
+        self.history.clear()
         self._emit('changelist_changed')
         # Always show a finished dialog. Otherwise, if you configuration
         # changes are made, the status window is gone so fast it feels
@@ -222,6 +960,14 @@ class Switch(metaclass=MetaSignals):
         time.sleep(1)
         self._emit('status_changed', None)
 
+    def commit_requests(self, step):
+        """
+        Returns the number of requests the given CommitStep is expected
+        to need. Subclasses should override this for steps that do not
+        need exactly one request.
+        """
+        return 1
+
     def commit_port_description_change(self, port, name):
         """
         Change the description of a port.
@@ -242,10 +988,12 @@ class Switch(metaclass=MetaSignals):
         """
         raise NotImplementedError()
 
-    def commit_pvids(self, pvids):
+    def commit_pvids(self, pvids, changed):
         """
         Change the pvid settings of all ports. pvids is a list
         containing, for each port, in order, the vlan dotq_id for the PVID.
+        changed is a list of the ports whose PVID actually changed,
+        which backends can use to skip writing the others.
         """
         raise NotImplementedError()
 
@@ -267,6 +1015,99 @@ class Switch(metaclass=MetaSignals):
         """
         raise NotImplementedError()
 
+    def get_link_status(self):
+        """
+        Retrieve the current link status of all ports, without
+        changing anything. Returns a dict mapping Port objects to a
+        dict of attributes to pass to Port.update_status(). This might
+        be called from another thread, so should not emit signals.
+        """
+        raise NotImplementedError()
+
+    def update_link_status(self, statuses):
+        """
+        Apply the result of get_link_status().
+        """
+        for port, attrs in statuses.items():
+            port.update_status(**attrs)
+
+    def get_mac_table(self):
+        """
+        Retrieve the forwarding database of the switch as a MacTable.
+        Like get_link_status(), this might be called from another
+        thread, so should not emit signals.
+        """
+        raise NotImplementedError()
+
+    def update_mac_table(self, table):
+        """
+        Apply the result of get_mac_table(), updating the number of
+        MACs shown for each port.
+        """
+        self.mac_table = table
+        counts = table.port_counts()
+        for port in self.ports:
+            port.update_status(mac_count=counts[port.num])
+
+    def get_counters(self):
+        """
+        Retrieve the traffic counters of all ports. Returns a
+        (timestamp, samples) tuple, where samples maps Port objects to
+        a list of counter values, in the order of counters.COUNTERS.
+        Like get_link_status(), this might be called from another
+        thread, so should not emit signals.
+        """
+        raise NotImplementedError()
+
+    def update_counters(self, result):
+        """
+        Apply the result of get_counters(), adding the samples to the
+        history of each port and showing the current rates.
+        """
+        timestamp, samples = result
+        for port, values in samples.items():
+            if port.counters is None:
+                port.counters = PortCounters(self.counter_history)
+            port.counters.add(timestamp, values)
+
+            rates = port.counters.rates()
+            if rates is None:
+                continue
+            errors = sum(rates[name] or 0 for name, bits in COUNTERS if name.endswith(('errors', 'discards')))
+            port.update_status(
+                traffic="in %s, out %s" % (format_bits(rates['in_octets']), format_bits(rates['out_octets'])),
+                errors="%.1f/s" % errors,
+            )
+
+    def get_lldp_neighbors(self):
+        """
+        Retrieve the neighbors of this switch as learned through LLDP.
+        Returns a list of (port number, chassis id, system name, port
+        id) tuples, where chassis id is a MAC address when the neighbor
+        uses that. This might be called from another thread, so should
+        not emit signals.
+        """
+        raise NotImplementedError()
+
+    def handle_notification(self, notification):
+        """
+        Handle an SNMP notification (see backends/traps.py). Returns
+        True when the notification came from this switch and was
+        applied.
+        """
+        return False
+
+    def probe(self):
+        """
+        Returns a value that changes whenever the configuration on the
+        switch changes, which should be (a lot) cheaper than
+        get_status(). To keep it cheap, backends can choose to only
+        notice some changes. This is used to check whether a switch
+        that was kept loaded must be reloaded. Returns None when this
+        is not supported.
+        """
+        return None
+
 
 class Port(metaclass=MetaSignals):
     signals = ['details_changed']
@@ -274,9 +1115,10 @@ class Port(metaclass=MetaSignals):
     def _emit(self, name, *args):
         """
         Convenience function to emit signals with self as first
-        argument.
+        argument. Signals can be coalesced, see Switch._coalesce().
         """
-        emit_signal(self, name, self, *args)
+        if self.switch is None or not self.switch._coalesce(self, name, args):
+            emit_signal(self, name, self, *args)
 
     def __init__(self, switch, num, description, pvid, **kwargs):
         """
@@ -290,6 +1132,8 @@ class Port(metaclass=MetaSignals):
         # TODO: Maybe editable attributes should be generalized?
         self._description = description
         self._pvid = pvid
+        # Traffic counter history, see Switch.update_counters()
+        self.counters = None
 
         self.__dict__.update(kwargs)
 
@@ -317,6 +1161,19 @@ class Port(metaclass=MetaSignals):
             self._pvid = value
             self._emit('details_changed')
 
+    def update_status(self, **kwargs):
+        """
+        Update (non-editable) status attributes of this port, emitting
+        details_changed only when something actually changed.
+        """
+        changed = False
+        for attr, value in kwargs.items():
+            if getattr(self, attr, None) != value:
+                setattr(self, attr, value)
+                changed = True
+        if changed:
+            self._emit('details_changed')
+
     up = property(lambda self: self.link_status != 'Down')
 
     def __repr__(self):
@@ -335,9 +1192,10 @@ class Vlan(metaclass=MetaSignals):
     def _emit(self, name, *args):
         """
         Convenience function to emit signals with self as first
-        argument.
+        argument. Signals can be coalesced, see Switch._coalesce().
         """
-        emit_signal(self, name, self, *args)
+        if self.switch is None or not self.switch._coalesce(self, name, args):
+            emit_signal(self, name, self, *args)
 
     def __init__(self, switch, internal_id, dotq_id, name, **kwargs):
         """
@@ -483,7 +1341,7 @@ class DeleteVlanChange(Change):
             # No need to change the name of a removed vlan (but do
             # copy the old value, in case we are later merged with
             # an AddVlanChange)
-            self.what.name = other.old
+            self.what._name = other.old
             return (self, [])
         elif (isinstance(other, PortVlanMembershipChange) and other.vlan == self.what):
             # No need to change memberships in a removed vlan (but
@@ -59,26 +59,38 @@ class FS726T(Switch):
     def __str__(self):
         return f"{self.__class__.__name__} at {self.address}"
 
-    def request(self, path, data=None, status=None, auto_login=True):
+    def request(self, path, data=None, status=None, auto_login=True, retries=0):
         if status:
             self._emit('status_changed', status)
 
         url = "http://%s%s" % (self.address, path)
 
+        # Identifies the request in cassettes, without the password
+        if data is None or isinstance(data, str):
+            key = [path, data]
+        else:
+            key = [path, urllib.parse.urlencode([(k, '*' if k == 'passwd' else v) for (k, v) in data])]
+
         if data and not isinstance(data, str):
             data = urllib.parse.urlencode(data).encode()
 
         if data is not None:
+            op = 'POST'
             log("HTTP POST request to %s (POST data %s)" % (url, str(data)))
         else:
+            op = 'GET'
             log("HTTP GET request to %s" % url)
 
-        response = urllib.request.urlopen(url, data).read().decode()
-        log('Done')
+        with self.stats.measure(op, path) as request:
+            raw = self.exchange(op, key, lambda: urllib.request.urlopen(url, data).read())
+            request.bytes = len(raw) + len(data or b'')
+            request.retries = retries
+        response = raw.decode()
+        log('Done (%d bytes in %.3fs)' % (len(raw), request.duration))
 
         if auto_login and "<input type=submit value=' Login '>" in response:
             self.do_login()
-            return self.request(path, data, status)
+            return self.request(path, data, status, retries=retries + 1)
         if "Only one user can login" in response:
             raise LoginException("Can only login from a single IP address: Log out the other client first")
         return response
@@ -172,7 +184,8 @@ class FS726T(Switch):
 
         self.request("/cgi/setvid=%s" % (vlan.internal_id), data, status)
 
-    def commit_pvids(self, pvids):
+    def commit_pvids(self, pvids, changed):
+        # The switch only supports setting all PVIDs at once
         # Do not change the order of parameters, that breaks the request :-S
         data = [
             ('tag_id', 255),
@@ -188,6 +201,14 @@ class FS726T(Switch):
         # Nothing to do, vlan is created by setting memberships
         pass
 
+    def commit_requests(self, step):
+        # Vlan names are only stored in our config and vlans are
+        # created by setting their memberships, so these do not need
+        # any requests.
+        if step.method in ('commit_vlan_description_change', 'commit_vlan_add'):
+            return 0
+        return super().commit_requests(step)
+
     def commit_vlan_delete(self, vlan):
         # Do not change the order of parameters, that breaks the request :-S
         data = [
@@ -1,15 +1,41 @@
+import functools
+import hashlib
+import math
 import pathlib
+import socket
+import threading
+import time
 
 try:
     import snimpy.manager
     import snimpy.mib
+    import snimpy.snmp
+    from pyasn1.type import univ
+    from pysnmp.entity import config as pysnmp_config
+    from pysnmp.entity.rfc3413.oneliner import cmdgen
+    from pysnmp.proto import rfc1902
 except ImportError as e:
     import sys
     sys.stderr.write(f"Failed to import snimpy: {e}\n")
     sys.stderr.write("Did you install vlan_admin with the 'snmp' extra?\n")
     raise SystemExit
 
-from .common import Port, Switch, Vlan
+from .. import cache
+from ..log import log
+from .common import MacTable, Port, Switch, Vlan
+
+# lldpRemTable from LLDP-MIB (IEEE 802.1AB), which is not among the
+# bundled MIBs, so its columns are used by OID
+LLDP_REM_TABLE = (1, 0, 8802, 1, 1, 2, 1, 4, 1, 1)
+LLDP_REM_CHASSIS_ID_SUBTYPE = 4
+LLDP_REM_CHASSIS_ID = 5
+LLDP_REM_PORT_ID = 7
+LLDP_REM_SYS_NAME = 9
+# Chassis id subtype for MAC addresses
+LLDP_CHASSIS_MAC = 4
+
+# SNMP-FRAMEWORK-MIB::snmpEngineID.0
+SNMP_ENGINE_ID = (1, 3, 6, 1, 6, 3, 10, 2, 1, 1, 0)
 
 # Unfortunately these are global, not per-manager instance, so load them here
 mib_path = pathlib.Path(__file__).parent.parent / 'snmp-mibs' / 'GS324Tx-v1.0.0.43-Mibs'
@@ -21,6 +47,239 @@ snimpy.manager.load('BRIDGE-MIB')
 snimpy.manager.load('Q-BRIDGE-MIB')
 
 
+@functools.lru_cache(maxsize=1024)
+def oid_name(oid):
+    """
+    Returns the name of the MIB object an OID belongs to (ignoring any
+    index), or the dotted OID when it is not known.
+    """
+    try:
+        return str(snimpy.mib.getByOid(oid))
+    except snimpy.mib.SMIException:
+        return '.'.join(str(i) for i in oid)
+
+
+def varbind_size(oid, value):
+    """
+    Approximate the size of a varbind. This does not know about the
+    actual BER encoding, so just counts OID components and the length of
+    octet string values.
+    """
+    try:
+        return len(oid) + len(value)
+    except TypeError:
+        return len(oid)
+
+
+def link_status(oper_status, speed):
+    """
+    Returns the link status to show for a port, based on its
+    ifOperStatus and ifHighSpeed.
+    """
+    if oper_status == "up" and speed:
+        return f"{speed}M" if speed else "Down"
+    elif oper_status == "up":
+        return "Up"
+    elif oper_status == "down":
+        return "Down"
+    else:
+        return f"Other: {oper_status}"
+
+
+# SNMPv3 master keys derived from passwords, see master_key()
+_master_keys = {}
+_master_keys_lock = threading.Lock()
+
+
+def master_key(password, auth_protocol, priv_protocol=None):
+    """
+    Returns the SNMPv3 master key (Ku, RFC 3414) for the given
+    authentication (or, when priv_protocol is given, privacy) password.
+
+    Deriving this hashes a megabyte of data, which pysnmp would
+    otherwise redo for every session (i.e. every thread talking to a
+    switch), so keys are cached in memory. They are never written to
+    disk, since a master key is worth as much as the password on every
+    switch that uses it (see load_localized_keys() instead).
+    """
+    ident = (str(auth_protocol), str(priv_protocol), password)
+
+    with _master_keys_lock:
+        key = _master_keys.get(ident)
+        if key is None:
+            if priv_protocol is None:
+                key = pysnmp_config.authServices[auth_protocol].hashPassphrase(password)
+            else:
+                key = pysnmp_config.privServices[priv_protocol].hashPassphrase(auth_protocol, password)
+            key = _master_keys[ident] = bytes(key)
+        return key
+
+
+def localized_keys_index(engine_id, username, auth_protocol, priv_protocol):
+    # Deliberately not derived from the password, so the cache file
+    # does not make guessing it any cheaper
+    protocols = ['.'.join(str(n) for n in protocol) for protocol in (auth_protocol, priv_protocol)]
+    return ':'.join([engine_id.hex(), username] + protocols)
+
+
+def load_localized_keys(address, username, auth_protocol, priv_protocol):
+    """
+    Returns an (engine ID, auth key, priv key) tuple with the SNMPv3 keys
+    localized (RFC 3414) for the switch at the given address from the
+    key cache file, or None. The priv key is None without privacy.
+
+    Since localized keys only work for a single engine ID (i.e. a
+    single switch), the cache maps the address to the engine ID, and
+    the engine ID, username and protocols to the keys. These are not
+    checked against the password, see NetgearSnmpSwitch.check_keys().
+    """
+    stored = cache.load('snmpv3-keys')
+    try:
+        engine_id = bytes.fromhex(stored['engines'][address])
+        keys = stored['keys'][localized_keys_index(engine_id, username, auth_protocol, priv_protocol)]
+        return (engine_id, bytes.fromhex(keys['auth']),
+                bytes.fromhex(keys['priv']) if keys['priv'] is not None else None)
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return None
+
+
+def update_localized_keys(address, keys=None, username=None, auth_protocol=None, priv_protocol=None):
+    """
+    Store the given (engine ID, auth key, priv key) tuple for the switch
+    at the given address in the key cache file, or forget the keys for
+    it when keys is None. Anything else in the file (e.g. the master
+    keys stored by older versions) is dropped.
+    """
+    with cache.lock:
+        stored = cache.load('snmpv3-keys')
+        engines = stored.get('engines')
+        all_keys = stored.get('keys')
+        if not isinstance(engines, dict) or not isinstance(all_keys, dict):
+            # Older versions stored master keys, drop these
+            engines, all_keys = {}, {}
+        if keys is None:
+            engine_id = engines.pop(address, None)
+            if engine_id is not None:
+                prefix = engine_id + ':'
+                all_keys = {index: v for index, v in all_keys.items() if not index.startswith(prefix)}
+        else:
+            engine_id, auth_key, priv_key = keys
+            engines[address] = engine_id.hex()
+            index = localized_keys_index(engine_id, username, auth_protocol, priv_protocol)
+            all_keys[index] = {'auth': auth_key.hex(), 'priv': priv_key.hex() if priv_key is not None else None}
+        try:
+            cache.save('snmpv3-keys', {'engines': engines, 'keys': all_keys})
+        except OSError as e:
+            log("Cannot write SNMPv3 key cache: %s" % e)
+
+
+class InstrumentedSession(snimpy.manager.DelegatedSession):
+    """
+    Wrapper around a snimpy session that records every request made in
+    the RequestStats of the given switch, and sends it through
+    Switch.exchange() (so it can be recorded in or replayed from a
+    cassette).
+    """
+    def __init__(self, session, switch):
+        super().__init__(session)
+        self.switch = switch
+        self.stats = switch.stats
+
+    def _key(self, oids):
+        return ['.'.join(str(n) for n in oid) for oid in oids]
+
+    def _target(self, oids):
+        return ','.join(dict.fromkeys(oid_name(oid) for oid in oids))
+
+    def _log(self, request):
+        log("SNMP %s %s: %d bytes in %.3fs" % (request.op, request.target, request.bytes, request.duration))
+
+    def get(self, *oids):
+        with self.stats.measure('GET', self._target(oids)) as request:
+            result = self.switch.exchange('GET', self._key(oids), lambda: self._session.get(*oids))
+            request.bytes = sum(varbind_size(oid, value) for oid, value in result)
+        self._log(request)
+        return result
+
+    def walkmore(self, *oids):
+        with self.stats.measure('WALK', self._target(oids)) as request:
+            result = self.switch.exchange('WALK', self._key(oids), lambda: self._session.walkmore(*oids))
+            request.bytes = sum(varbind_size(oid, value) for oid, value in result)
+        self._log(request)
+        return result
+
+    def walk(self, *oids):
+        # Same as snimpy.snmp.Session.walk, but that calls walkmore on
+        # the unwrapped session, bypassing our statistics.
+        return ((noid, result)
+                for oid in oids
+                for noid, result in self.walkmore(oid)
+                if noid[:len(oid)] == oid)
+
+    def walk_stream(self, oid, bulk):
+        """
+        Walk the subtree below the given OID with GETBULK requests of
+        bulk values each, yielding (oid, value) tuples as each response
+        arrives. Unlike walk(), this never keeps more than a single
+        response in memory, which matters for big tables (e.g. the
+        forwarding database).
+
+        This uses snimpy session internals, when these are missing
+        (e.g. with a newer snimpy), this falls back to walk().
+        """
+        session = self._session
+        if not all(hasattr(session, attr) for attr in ('_cmdgen', '_auth', '_transport', '_contextname', '_convert')):
+            yield from self.walk(oid)
+            return
+
+        kwargs = {}
+        if session._contextname:
+            kwargs['contextName'] = rfc1902.OctetString(session._contextname)
+
+        def bulk_request(start):
+            # Use lexicographicMode and maxCalls to do just a single
+            # request, snimpy always walks the entire subtree
+            error, status, index, table = session._cmdgen.bulkCmd(
+                session._auth, session._transport, 0, bulk, start,
+                lexicographicMode=True, maxCalls=1, **kwargs)
+            if error:
+                raise snimpy.snmp.SNMPException(str(error))
+            if status:
+                raise snimpy.snmp.SNMPException(status.prettyPrint())
+            # Values are converted right away, so they can be recorded.
+            # endOfMibView (a Null) becomes None.
+            return [
+                (tuple(name), varbind_size(name, value),
+                 None if isinstance(value, univ.Null) else session._convert(value))
+                for row in table for name, value in row
+            ]
+
+        start = oid
+        while True:
+            with self.stats.measure('WALK', oid_name(oid)) as request:
+                varbinds = self.switch.exchange('BULK', self._key([start]) + [bulk], lambda: bulk_request(start))
+                request.bytes = sum(size for name, size, value in varbinds)
+            self._log(request)
+
+            for name, size, value in varbinds:
+                if name[:len(oid)] != oid or value is None:
+                    return
+                yield name, value
+
+            if not varbinds:
+                return
+            start = varbinds[-1][0]
+
+    def set(self, *args):
+        oids = args[0::2]
+        with self.stats.measure('SET', self._target(oids)) as request:
+            request.bytes = sum(varbind_size(oid, value.pack()) for oid, value in zip(oids, args[1::2]))
+            key = self._key(oids) + [value.pack().prettyPrint() for value in args[1::2]]
+            result = self.switch.exchange('SET', key, lambda: self._session.set(*args))
+        self._log(request)
+        return result
+
+
 class NetgearSnmpSwitch(Switch):
     """
     This class implements controlling netgear switches via SNMP.
@@ -56,6 +315,9 @@ class NetgearSnmpSwitch(Switch):
         ('Description', 'description', True),
         ('Link', 'link_status', False),
         ('PVID', 'pvid', False),
+        ('MAC addresses', 'mac_count', False),
+        ('Traffic', 'traffic', False),
+        ('Errors and discards', 'errors', False),
     ]]
 
     vlan_attrs = [[
@@ -63,6 +325,24 @@ class NetgearSnmpSwitch(Switch):
         ('VLAN name', 'name', True),
     ]]
 
+    supports_link_polling = True
+    supports_mac_table = True
+    supports_counters = True
+    supports_lldp = True
+
+    # Maximum number of varbinds to put in a single GET request, to
+    # stay well below the maximum message size.
+    max_varbinds = 24
+
+    # Maximum number of varbinds to use when sampling counters. This
+    # starts out high, to get all counters in a single request, and is
+    # halved whenever the switch says the response would be too big.
+    counter_varbinds = 256
+
+    # Number of values returned per GETBULK request when walking (this
+    # is the snimpy default)
+    walk_bulk = 40
+
     def __str__(self):
         return f"{self.product or 'switch'} at {self.address}"
 
@@ -101,14 +381,422 @@ class NetgearSnmpSwitch(Switch):
             # does not work)
             raise ValueError(err)
 
-        self.snmp = snimpy.manager.Manager(
+        self.manager_args = dict(
             host=self.address, version=version, community=community,
             secname=username, authpassword=password, authprotocol=auth,
             privprotocol=priv, privpassword=privpassword,
         )
+        self.commit_concurrency = int(config.get("commit_concurrency", 4))
+        self.trap_community = config.get("trap_community", community)
+        self._source_addresses = None
+        self._thread_snmp = threading.local()
+        self.cache_keys = config.as_bool("cache_keys") if "cache_keys" in config else False
+        # SNMPv3 keys localized for this switch as an (engine ID, auth
+        # key, priv key) tuple, once known, see usm_user_data()
+        self._localized_keys = None
+        # Whether the key cache was read, and whether the keys were
+        # checked (and stored), see check_keys()
+        self._keys_loaded = False
+        self._keys_checked = False
+        # Reentrant, since check_keys() creates managers
+        self._keys_lock = threading.RLock()
+        # (sysUpTime, other scalars, digest) of the last probe()
+        self._probe = None
 
         super().__init__(config)
 
+        # Create the manager for the main thread right away, so any
+        # configuration errors are reported early
+        self.snmp
+
+    @property
+    def snmp(self):
+        """
+        The snimpy manager to use. snimpy sessions cannot be shared
+        between threads, so each thread (e.g. commit workers) gets its
+        own.
+        """
+        manager = getattr(self._thread_snmp, 'manager', None)
+        if manager is None:
+            manager = snimpy.manager.Manager(**self.manager_args)
+            if self.manager_args['version'] == 3:
+                manager._session._auth = self.usm_user_data(manager._session._auth)
+            # Route all requests through our statistics. Manager does
+            # not offer a public way to wrap its session, but it does
+            # the same thing internally for caching.
+            manager._session = InstrumentedSession(manager._session, self)
+            self._thread_snmp.manager = manager
+        return manager
+
+    def usm_user_data(self, auth):
+        """
+        Returns a copy of the UsmUserData built by snimpy from our
+        passwords, that uses keys localized for this switch when known
+        (and, with cache_keys, stored in the key cache), or (cached)
+        master keys instead.
+        """
+        if auth.authKey is None:
+            return auth
+
+        with self._keys_lock:
+            if self.cache_keys and not self._keys_loaded:
+                self._keys_loaded = True
+                self._localized_keys = load_localized_keys(
+                    self.address, auth.userName, auth.authProtocol, auth.privProtocol)
+            keys = self._localized_keys
+
+        if keys is not None:
+            engine_id, auth_key, priv_key = keys
+            return cmdgen.UsmUserData(
+                auth.userName, auth_key, priv_key,
+                authProtocol=auth.authProtocol, privProtocol=auth.privProtocol,
+                securityName=auth.securityName, securityEngineId=rfc1902.OctetString(engine_id),
+                authKeyType=pysnmp_config.usmKeyTypeLocalized, privKeyType=pysnmp_config.usmKeyTypeLocalized,
+            )
+
+        auth_key = master_key(auth.authKey, auth.authProtocol)
+        priv_key = None
+        priv_key_type = pysnmp_config.usmKeyTypePassphrase
+        if auth.privKey is not None:
+            priv_key = master_key(auth.privKey, auth.authProtocol, auth.privProtocol)
+            priv_key_type = pysnmp_config.usmKeyTypeMaster
+
+        return cmdgen.UsmUserData(
+            auth.userName, auth_key, priv_key,
+            authProtocol=auth.authProtocol, privProtocol=auth.privProtocol,
+            securityName=auth.securityName,
+            authKeyType=pysnmp_config.usmKeyTypeMaster, privKeyType=priv_key_type,
+        )
+
+    def check_keys(self):
+        """
+        With cache_keys, make sure the SNMPv3 keys localized for this
+        switch are in the key cache. When they were derived from the
+        passwords, they are localized for the engine ID retrieved from
+        the switch and stored. When they were read from the cache,
+        this checks that they still work (they are not checked against
+        the passwords), deriving them from the passwords again when
+        not (e.g. when a password was changed or the switch replaced).
+        """
+        args = self.manager_args
+        if args['version'] != 3 or args['authpassword'] is None or not self.cache_keys:
+            return
+
+        with self._keys_lock:
+            if self._keys_checked:
+                return
+            # Makes sure the key cache is read
+            self.snmp
+            cached = self._localized_keys
+            try:
+                engine_id = self.get_engine_id()
+                if cached is not None and engine_id != cached[0]:
+                    raise snimpy.snmp.SNMPException("engine ID changed")
+            except snimpy.snmp.SNMPException as e:
+                if cached is None:
+                    raise
+                log("Cached SNMPv3 keys for %s do not work, deriving them again: %s" % (self, e))
+                update_localized_keys(self.address)
+                self._localized_keys = cached = None
+                # Recreate the managers of all threads with master keys
+                self._thread_snmp = threading.local()
+                engine_id = self.get_engine_id()
+
+            if cached is None:
+                # Keep using the master keys for managers that already
+                # exist, but use the localized keys from now on
+                # The UsmUserData built by usm_user_data()
+                usm = self.snmp._session._session._auth
+                engine = rfc1902.OctetString(engine_id)
+                auth_key = bytes(pysnmp_config.authServices[usm.authProtocol].localizeKey(
+                    master_key(args['authpassword'], usm.authProtocol), engine))
+                priv_key = None
+                if args['privpassword'] is not None:
+                    priv_key = bytes(pysnmp_config.privServices[usm.privProtocol].localizeKey(
+                        usm.authProtocol, master_key(args['privpassword'], usm.authProtocol, usm.privProtocol),
+                        engine))
+                self._localized_keys = (engine_id, auth_key, priv_key)
+                update_localized_keys(self.address, self._localized_keys, usm.userName,
+                                      usm.authProtocol, usm.privProtocol)
+            self._keys_checked = True
+
+    def get_engine_id(self):
+        (oid, engine_id), = self.snmp._session.get(SNMP_ENGINE_ID)
+        return bytes(engine_id)
+
+    def get_indexed(self, columns, indexes, limit='max_varbinds'):
+        """
+        Retrieve the given columns (a list of (mib, column name)
+        tuples) for the given table indexes only, using as few
+        multi-varbind GETs as possible. Returns a dict mapping (column
+        name, index) to the value.
+
+        limit is the name of the attribute with the maximum number of
+        varbinds per request. When the switch cannot send a response
+        that big, this attribute is halved (so this is remembered).
+        """
+        nodes = [snimpy.mib.get(mib, name) for mib, name in columns]
+        oids = [(node, index) for index in indexes for node in nodes]
+
+        values = {}
+        start = 0
+        while start < len(oids):
+            batch = oids[start:start + getattr(self, limit)]
+            try:
+                result = self.snmp._session.get(*(node.oid + (index,) for node, index in batch))
+            except snimpy.snmp.SNMPTooBig:
+                if len(batch) == 1:
+                    raise
+                setattr(self, limit, len(batch) // 2)
+                log("Response too big, using at most %d varbinds per request" % getattr(self, limit))
+                continue
+            start += len(batch)
+            for (node, index), (oid, value) in zip(batch, result):
+                if value is not None:
+                    value = node.type(node, value)
+                values[(str(node), index)] = value
+        return values
+
+    def get_interface_columns(self, columns, if_indexes, if_count):
+        """
+        Retrieve the given IF-MIB columns (a list of (mib, column name)
+        tuples) for the given ifIndexes. if_count should be the total
+        number of interfaces (ifNumber). Returns a dict mapping (column
+        name, ifIndex) to the value.
+
+        This uses targeted GETs when the interfaces are a small part of
+        all interfaces, or walks the columns when that needs fewer
+        requests (the walked values for other interfaces are then
+        returned too).
+        """
+        walk_requests = len(columns) * (if_count // self.walk_bulk + 1)
+        get_requests = math.ceil(len(columns) * len(if_indexes) / self.max_varbinds)
+
+        if get_requests <= walk_requests:
+            return self.get_indexed(columns, if_indexes)
+
+        # Would be easier if we could just fetch the entire table, but
+        # this is not supported yet:
+        # https://github.com/vincentbernat/snimpy/issues/46#issuecomment-209917027
+        values = {}
+        for mib, name in columns:
+            for index, value in getattr(self.snmp, name).iteritems():
+                values[(name, index)] = value
+        return values
+
+    def get_chassis(self):
+        """
+        Returns a dict with the entPhysicalTable columns we use for the
+        chassis entity, or None if there is none. On all tested netgear
+        switches, the (first) chassis entity contains the useful info.
+
+        Finding the chassis needs a walk of entPhysicalClass, which can
+        have hundreds of rows on stacked or modular switches. To
+        prevent that, the index found is cached (per switch address,
+        checked against the serial number) and tried first next time.
+        """
+        columns = [
+            ('ENTITY-MIB', 'entPhysicalClass'),
+            ('ENTITY-MIB', 'entPhysicalModelName'),
+            ('ENTITY-MIB', 'entPhysicalSoftwareRev'),
+            ('ENTITY-MIB', 'entPhysicalSerialNum'),
+        ]
+
+        def get_row(index):
+            values = self.get_indexed(columns, [index])
+            return {name: values[(name, index)] for (mib, name) in columns}
+
+        cached = cache.load('chassis').get(self.address)
+        if cached:
+            try:
+                row = get_row(cached['index'])
+                if row['entPhysicalClass'] == "chassis" and str(row['entPhysicalSerialNum']) == cached['serial']:
+                    return row
+            except snimpy.snmp.SNMPException:
+                pass
+
+        for index, cls in self.snmp.entPhysicalClass.iteritems():
+            if cls == "chassis":
+                index = int(index)
+                row = get_row(index)
+                try:
+                    cache.update('chassis', self.address, {'index': index, 'serial': str(row['entPhysicalSerialNum'])})
+                except OSError as e:
+                    # The cache only saves some requests next time
+                    log("Cannot write chassis cache: %s" % e)
+                return row
+        return None
+
+    def get_counters(self):
+        """
+        Sample the traffic counters of all ports, using as few
+        requests as the switch allows (see counter_varbinds).
+        """
+        columns = [
+            ('IF-MIB', 'ifHCInOctets'),
+            ('IF-MIB', 'ifHCOutOctets'),
+            ('IF-MIB', 'ifInErrors'),
+            ('IF-MIB', 'ifOutErrors'),
+            ('IF-MIB', 'ifInDiscards'),
+            ('IF-MIB', 'ifOutDiscards'),
+        ]
+        values = self.get_indexed(columns, [port.if_index for port in self.ports], limit='counter_varbinds')
+        timestamp = time.time()
+        return timestamp, {
+            port: [int(values[(name, port.if_index)] or 0) for mib, name in columns]
+            for port in self.ports
+        }
+
+    def get_link_status(self):
+        values = self.get_indexed(
+            [('IF-MIB', 'ifOperStatus'), ('IF-MIB', 'ifHighSpeed')],
+            [port.if_index for port in self.ports],
+        )
+        return {
+            port: {'link_status': link_status(
+                values[('ifOperStatus', port.if_index)],
+                values[('ifHighSpeed', port.if_index)],
+            )}
+            for port in self.ports
+        }
+
+    def probe(self):
+        """
+        Returns a digest of the vlan configuration and port
+        descriptions. To keep this cheap, this first GETs a few scalars
+        that change when vlans are added or deleted, when interfaces
+        are added or removed, or when the switch reboots, and only
+        walks the vlan tables and port descriptions when one of these
+        changed since the previous probe (otherwise the previous digest
+        is returned). Note that this means that changes to memberships,
+        PVIDs or names alone are not noticed.
+        """
+        scalars = self.get_indexed([
+            ('RFC1213-MIB', 'sysUpTime'),
+            ('Q-BRIDGE-MIB', 'dot1qNumVlans'),
+            ('Q-BRIDGE-MIB', 'dot1qVlanNumDeletes'),
+            ('IF-MIB', 'ifTableLastChange'),
+        ], [0])
+        uptime = scalars.pop(('sysUpTime', 0))
+        if self._probe is not None:
+            last_uptime, last_scalars, digest = self._probe
+            rebooted = uptime is None or last_uptime is None or uptime < last_uptime
+            if scalars == last_scalars and not rebooted:
+                self._probe = (uptime, scalars, digest)
+                return digest
+
+        columns = [
+            ('Q-BRIDGE-MIB', 'dot1qVlanStaticName'),
+            ('Q-BRIDGE-MIB', 'dot1qVlanStaticEgressPorts'),
+            ('Q-BRIDGE-MIB', 'dot1qVlanStaticUntaggedPorts'),
+            ('Q-BRIDGE-MIB', 'dot1qPvid'),
+            ('IF-MIB', 'ifAlias'),
+        ]
+        digest = hashlib.sha256()
+        for mib, name in columns:
+            for oid, value in self.snmp._session.walk(snimpy.mib.get(mib, name).oid):
+                digest.update(repr((oid, value)).encode())
+        self._probe = (uptime, scalars, digest.hexdigest())
+        return self._probe[2]
+
+    def commit_all(self):
+        super().commit_all()
+        # Committing memberships, PVIDs or names does not change the
+        # scalars probe() checks, so make it walk the tables again
+        self._probe = None
+
+    def get_mac_table(self):
+        """
+        Retrieve the forwarding database from dot1qTpFdbTable. This
+        table can be big, so it is streamed (see walk_stream) straight
+        into the index.
+        """
+        # The forwarding database is indexed by filtering database id,
+        # which is usually the vlan id, but not necessarily, so map it
+        # back through dot1qVlanFdbId (indexed by timemark and vlan id)
+        fdb_vlans = {}
+        for oid, fdb_id in self.snmp._session.walk(snimpy.mib.get('Q-BRIDGE-MIB', 'dot1qVlanFdbId').oid):
+            fdb_vlans.setdefault(fdb_id, set()).add(oid[-1])
+
+        table = MacTable()
+        column = snimpy.mib.get('Q-BRIDGE-MIB', 'dot1qTpFdbPort').oid
+        for oid, port_num in self.snmp._session.walk_stream(column, self.walk_bulk):
+            if port_num == 0:
+                # Learned on an unknown port, or the switch itself
+                continue
+            fdb_id = oid[len(column)]
+            mac = bytes(oid[len(column) + 1:]).hex()
+            vlans = fdb_vlans.get(fdb_id, {fdb_id})
+            # With shared learning, a MAC can be in any of the vlans
+            # using this fdb
+            vlan_id = next(iter(vlans)) if len(vlans) == 1 else None
+            table.add(mac, vlan_id, port_num)
+        return table
+
+    def get_lldp_neighbors(self):
+        """
+        Retrieve the LLDP neighbors from lldpRemTable. Switches that do
+        not support LLDP simply have no neighbors.
+        """
+        # Maps (local port, remote index) to a dict of columns. The
+        # table is also indexed by a timemark, which is ignored.
+        rows = {}
+        for column in (LLDP_REM_CHASSIS_ID_SUBTYPE, LLDP_REM_CHASSIS_ID, LLDP_REM_PORT_ID, LLDP_REM_SYS_NAME):
+            for oid, value in self.snmp._session.walk(LLDP_REM_TABLE + (column,)):
+                rows.setdefault(oid[-2:], {})[column] = value
+
+        # The local port number is usually the ifIndex, but might also
+        # be the bridge port number
+        by_if_index = {port.if_index: port for port in self.ports}
+        by_num = {port.num: port for port in self.ports}
+
+        neighbors = []
+        for (local, index), row in rows.items():
+            port = by_if_index.get(local) or by_num.get(local)
+            if port is None:
+                continue
+            chassis_id = row.get(LLDP_REM_CHASSIS_ID, b'')
+            if row.get(LLDP_REM_CHASSIS_ID_SUBTYPE) == LLDP_CHASSIS_MAC:
+                chassis_id = chassis_id.hex()
+            else:
+                chassis_id = chassis_id.decode(errors='replace')
+            neighbors.append((
+                port.num, chassis_id,
+                row.get(LLDP_REM_SYS_NAME, b'').decode(errors='replace'),
+                row.get(LLDP_REM_PORT_ID, b'').decode(errors='replace'),
+            ))
+        return neighbors
+
+    @property
+    def source_addresses(self):
+        """
+        The IP addresses notifications from this switch can come from.
+        """
+        if self._source_addresses is None:
+            host = self.address
+            if host.count(':') == 1:
+                # Strip port number
+                host = host.split(':')[0]
+            infos = socket.getaddrinfo(host.strip('[]'), 161, proto=socket.IPPROTO_UDP)
+            self._source_addresses = {info[4][0] for info in infos}
+        return self._source_addresses
+
+    def handle_notification(self, notification):
+        if notification.source not in self.source_addresses:
+            return False
+        if self.trap_community is not None and notification.community != self.trap_community:
+            return False
+        if not notification.is_link_change:
+            return False
+
+        for port in self.ports:
+            if port.if_index == notification.if_index:
+                # Notifications do not include the speed, the next
+                # poll will fill that in.
+                port.update_status(link_status=link_status(notification.oper_status, None))
+                return True
+        return False
+
     def commit_port_description_change(self, port, description):
         self._emit('status_changed', f"Committing port {port.num} description...")
         self.snmp.ifAlias[port.if_index] = description
@@ -135,13 +823,18 @@ class NetgearSnmpSwitch(Switch):
                 set_port_bit(egress, port)
                 set_port_bit(untagged, port)
 
-        self.snmp.dot1qVlanStaticEgressPorts[vlan.dotq_id] = egress
-        self.snmp.dot1qVlanStaticUntaggedPorts[vlan.dotq_id] = untagged
+        # Inside a with block, snimpy groups all SETs into a single
+        # request
+        with self.snmp:
+            self.snmp.dot1qVlanStaticEgressPorts[vlan.dotq_id] = egress
+            self.snmp.dot1qVlanStaticUntaggedPorts[vlan.dotq_id] = untagged
 
-    def commit_pvids(self, pvids):
+    def commit_pvids(self, pvids, changed):
         self._emit('status_changed', "Committing PVID settings...")
-        for port, pvid in zip(self.ports, pvids):
-            self.snmp.dot1qPvid[port.num] = pvid
+        with self.snmp:
+            for port, pvid in zip(self.ports, pvids):
+                if port in changed:
+                    self.snmp.dot1qPvid[port.num] = pvid
 
     def commit_vlan_delete(self, vlan):
         self._emit('status_changed', f"Deleting vlan {vlan.dotq_id}...")
@@ -153,12 +846,26 @@ class NetgearSnmpSwitch(Switch):
 
     def get_status(self):
         self._emit('status_changed', "Retrieving switch status...")
-        self.hostname = self.snmp.sysName.decode()
-        self.location = self.snmp.sysLocation.decode()
-        self.contact = self.snmp.sysContact.decode()
-        self.uptime = self.snmp.sysUpTime
-
-        mac = self.snmp.dot1dBaseBridgeAddress
+        self.check_keys()
+        # Start from scratch, so the status can be retrieved again
+        self.ports = []
+        self.vlans = []
+        self.dotq_vlans = {}
+        # Get all scalars in a single request
+        scalars = self.get_indexed([
+            ('RFC1213-MIB', 'sysName'),
+            ('RFC1213-MIB', 'sysLocation'),
+            ('RFC1213-MIB', 'sysContact'),
+            ('RFC1213-MIB', 'sysUpTime'),
+            ('BRIDGE-MIB', 'dot1dBaseBridgeAddress'),
+            ('IF-MIB', 'ifNumber'),
+        ], [0])
+        self.hostname = scalars[('sysName', 0)].decode()
+        self.location = scalars[('sysLocation', 0)].decode()
+        self.contact = scalars[('sysContact', 0)].decode()
+        self.uptime = scalars[('sysUpTime', 0)]
+
+        mac = scalars[('dot1dBaseBridgeAddress', 0)]
         raw_len = 6
         encoded_len = raw_len * 2 + raw_len - 1
         double_encoded_len = encoded_len * 2 + encoded_len - 1
@@ -181,32 +888,34 @@ class NetgearSnmpSwitch(Switch):
         else:
             raise ValueError(f"Unsupported MAC address encoding: {mac}")
 
-        # On all tested netgear switches, the "chassis" entity contains the
-        # useful info, so look for the first chassis entity.
-        for i, cls in self.snmp.entPhysicalClass.iteritems():
-                if cls == "chassis":
-                    self.product = self.snmp.entPhysicalModelName[i]
-                    self.software_version = self.snmp.entPhysicalSoftwareRev[i]
-                    self.serial_number = self.snmp.entPhysicalSerialNum[i]
-                    break
+        chassis = self.get_chassis()
+        if chassis:
+            self.product = chassis['entPhysicalModelName']
+            self.software_version = chassis['entPhysicalSoftwareRev']
+            self.serial_number = chassis['entPhysicalSerialNum']
+
+        # Find out which interfaces are bridge ports first, so we only
+        # need to fetch attributes for those (switches can have many
+        # more interfaces, e.g. for LAGs, VLAN routing or the CPU).
+        bridge_ports = dict(self.snmp.dot1dBasePortIfIndex.iteritems())
 
         # Prefetch these values for all ports at once, which is a *lot*
-        # faster than fetching them one by one in the below loop. Would
-        # be easier if we could just fetch the entire table, but this is
-        # not supported yet: https://github.com/vincentbernat/snimpy/issues/46#issuecomment-209917027
-        all_names = dict(self.snmp.ifName.iteritems())
-        all_descriptions = dict(self.snmp.ifAlias.iteritems())
-        all_speeds = dict(self.snmp.ifHighSpeed.iteritems())
-        all_admin_statuses = dict(self.snmp.ifAdminStatus.iteritems())
-        all_oper_statuses = dict(self.snmp.ifOperStatus.iteritems())
-        all_pvids = dict(self.snmp.dot1qPvid)
-
-        for bridge_port, if_index in self.snmp.dot1dBasePortIfIndex.iteritems():
-            name = all_names[if_index]
-            description = all_descriptions[if_index]
-            speed = all_speeds[if_index]
-            admin_status = all_admin_statuses[if_index]
-            oper_status = all_oper_statuses[if_index]
+        # faster than fetching them one by one in the below loop.
+        values = self.get_interface_columns([
+            ('IF-MIB', 'ifName'),
+            ('IF-MIB', 'ifAlias'),
+            ('IF-MIB', 'ifHighSpeed'),
+            ('IF-MIB', 'ifAdminStatus'),
+            ('IF-MIB', 'ifOperStatus'),
+        ], list(bridge_ports.values()), scalars[('ifNumber', 0)])
+        all_pvids = dict(self.snmp.dot1qPvid.iteritems())
+
+        for bridge_port, if_index in bridge_ports.items():
+            name = values[('ifName', if_index)]
+            description = values[('ifAlias', if_index)]
+            speed = values[('ifHighSpeed', if_index)]
+            admin_status = values[('ifAdminStatus', if_index)]
+            oper_status = values[('ifOperStatus', if_index)]
             pvid = all_pvids[bridge_port]
 
             if admin_status == "up":
@@ -224,19 +933,10 @@ class NetgearSnmpSwitch(Switch):
                 # just ignore these ports
                 continue
 
-            if oper_status == "up" and speed:
-                link_status = f"{speed}M" if speed else "Down"
-            elif oper_status == "up":
-                link_status = "Up"
-            elif oper_status == "down":
-                link_status = "Down"
-            else:
-                link_status = f"Other: {oper_status}"
-
             port = Port(
-                self, bridge_port, link_status=link_status,
+                self, bridge_port, link_status=link_status(oper_status, speed),
                 description=description, name=name, if_index=if_index,
-                enabled=enabled, pvid=pvid,
+                enabled=enabled, pvid=pvid, mac_count='', traffic='', errors='',
             )
             self.ports.append(port)
 
@@ -0,0 +1,216 @@
+"""
+Minimal SNMP notification receiver, used to learn about link changes
+as soon as they happen instead of waiting for the next poll.
+
+This only handles SNMPv1 traps and SNMPv2c traps and informs. It does
+not decode SNMPv3 messages, so switches must be configured to send
+community-based notifications.
+
+Running this module sends a synthetic notification, which is useful
+to test the receiver without a switch:
+
+    python -m vlan_admin.backends.traps localhost:1162 linkDown 5
+"""
+
+import argparse
+import socket
+
+try:
+    from pyasn1.codec.ber import decoder, encoder
+    from pysnmp.proto import api
+except ImportError as e:
+    import sys
+    sys.stderr.write(f"Failed to import pysnmp: {e}\n")
+    sys.stderr.write("Did you install vlan_admin with the 'snmp' extra?\n")
+    raise SystemExit
+
+from ..log import log
+
+SYS_UPTIME = (1, 3, 6, 1, 2, 1, 1, 3, 0)
+SNMP_TRAP_OID = (1, 3, 6, 1, 6, 3, 1, 1, 4, 1, 0)
+LINK_DOWN = (1, 3, 6, 1, 6, 3, 1, 1, 5, 3)
+LINK_UP = (1, 3, 6, 1, 6, 3, 1, 1, 5, 4)
+IF_INDEX = (1, 3, 6, 1, 2, 1, 2, 2, 1, 1)
+IF_ADMIN_STATUS = (1, 3, 6, 1, 2, 1, 2, 2, 1, 7)
+IF_OPER_STATUS = (1, 3, 6, 1, 2, 1, 2, 2, 1, 8)
+
+# Values of ifOperStatus, as far as we need them
+OPER_STATUS = {1: 'up', 2: 'down'}
+
+# Generic trap numbers used by SNMPv1 for link traps
+V1_GENERIC_TRAPS = {2: LINK_DOWN, 3: LINK_UP}
+
+
+class Notification(object):
+    """
+    A received trap or inform. varbinds maps OID tuples to the
+    (pyasn1) values.
+    """
+    def __init__(self, source, community, trap_oid, varbinds):
+        self.source = source
+        self.community = community
+        self.trap_oid = trap_oid
+        self.varbinds = varbinds
+
+    def _column(self, column):
+        """
+        Returns (index, value) of the first varbind in the given table
+        column, or (None, None).
+        """
+        for oid, value in self.varbinds.items():
+            if oid[:len(column)] == column and len(oid) > len(column):
+                return oid[len(column)], value
+        return None, None
+
+    @property
+    def is_link_change(self):
+        return self.trap_oid in (LINK_UP, LINK_DOWN)
+
+    @property
+    def if_index(self):
+        index, value = self._column(IF_INDEX)
+        if index is None:
+            # Some agents only send ifAdminStatus and ifOperStatus
+            index, value = self._column(IF_OPER_STATUS)
+        return index
+
+    @property
+    def oper_status(self):
+        index, value = self._column(IF_OPER_STATUS)
+        if value is not None:
+            return OPER_STATUS.get(int(value), str(value))
+        return 'up' if self.trap_oid == LINK_UP else 'down'
+
+    def __str__(self):
+        name = {LINK_UP: 'linkUp', LINK_DOWN: 'linkDown'}.get(self.trap_oid)
+        name = name or '.'.join(str(i) for i in self.trap_oid)
+        return "%s from %s (ifIndex %s)" % (name, self.source, self.if_index)
+
+
+def decode(data, source):
+    """
+    Decode a notification message. Returns a (Notification, response)
+    tuple, where response is the encoded message to send back (for
+    informs) or None. Returns (None, None) for messages that are not
+    notifications.
+    """
+    version = int(api.decodeMessageVersion(data))
+    if version not in api.protoModules:
+        return None, None
+
+    proto = api.protoModules[version]
+    msg, rest = decoder.decode(data, asn1Spec=proto.Message())
+    community = bytes(proto.apiMessage.getCommunity(msg)).decode(errors='replace')
+    pdu = proto.apiMessage.getPDU(msg)
+    response = None
+
+    if version == api.protoVersion1 and pdu.isSameTypeWith(proto.TrapPDU()):
+        generic = int(proto.apiTrapPDU.getGenericTrap(pdu))
+        trap_oid = V1_GENERIC_TRAPS.get(generic, tuple(proto.apiTrapPDU.getEnterprise(pdu)))
+        varbinds = proto.apiTrapPDU.getVarBinds(pdu)
+    elif version == api.protoVersion2c and pdu.isSameTypeWith(proto.SNMPv2TrapPDU()):
+        varbinds = proto.apiPDU.getVarBinds(pdu)
+        trap_oid = None
+    elif version == api.protoVersion2c and pdu.isSameTypeWith(proto.InformRequestPDU()):
+        varbinds = proto.apiPDU.getVarBinds(pdu)
+        trap_oid = None
+        # Informs must be acknowledged, with the same varbinds
+        response_msg = proto.apiMessage.getResponse(msg)
+        proto.apiPDU.setVarBinds(proto.apiMessage.getPDU(response_msg), varbinds)
+        response = encoder.encode(response_msg)
+    else:
+        return None, None
+
+    varbinds = {tuple(oid): value for oid, value in varbinds}
+    if trap_oid is None:
+        trap_oid = tuple(varbinds.get(SNMP_TRAP_OID, ()))
+    return Notification(source, community, trap_oid, varbinds), response
+
+
+def encode(trap_oid, if_index, oper_status, community='public', inform=False):
+    """
+    Build an SNMPv2c link trap (or inform) message, like a switch would
+    send.
+    """
+    proto = api.protoModules[api.protoVersion2c]
+    pdu = proto.InformRequestPDU() if inform else proto.SNMPv2TrapPDU()
+    proto.apiTrapPDU.setDefaults(pdu)
+    status = {v: k for k, v in OPER_STATUS.items()}[oper_status]
+    proto.apiTrapPDU.setVarBinds(pdu, [
+        (SYS_UPTIME, proto.TimeTicks(0)),
+        (SNMP_TRAP_OID, proto.ObjectIdentifier(trap_oid)),
+        (IF_INDEX + (if_index,), proto.Integer(if_index)),
+        (IF_ADMIN_STATUS + (if_index,), proto.Integer(1)),
+        (IF_OPER_STATUS + (if_index,), proto.Integer(status)),
+    ])
+
+    msg = proto.Message()
+    proto.apiMessage.setDefaults(msg)
+    proto.apiMessage.setCommunity(msg, community)
+    proto.apiMessage.setPDU(msg, pdu)
+    return encoder.encode(msg)
+
+
+class TrapReceiver(object):
+    """
+    Receives notifications on a UDP socket and passes them to a
+    callback. Call receive() whenever the socket is readable (e.g. from
+    an urwid watch_file callback).
+    """
+    def __init__(self, address, callback):
+        self.callback = callback
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(address)
+        self.socket.setblocking(False)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def close(self):
+        self.socket.close()
+
+    def receive(self):
+        while True:
+            try:
+                data, source = self.socket.recvfrom(65535)
+            except BlockingIOError:
+                return
+
+            try:
+                notification, response = decode(data, source[0])
+            except Exception as e:
+                log("Ignoring undecodable SNMP message from %s: %s" % (source[0], e))
+                continue
+
+            if notification is None:
+                continue
+            if response is not None:
+                self.socket.sendto(response, source)
+            self.callback(notification)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a synthetic SNMP link trap, to test the trap receiver")
+    parser.add_argument('address', help="[host:]port to send to (default host: localhost)")
+    parser.add_argument('trap', choices=['linkUp', 'linkDown'])
+    parser.add_argument('if_index', type=int, help="ifIndex of the interface")
+    parser.add_argument('--community', default='public')
+    parser.add_argument('--inform', action='store_true', help="Send an inform and wait for the response")
+    args = parser.parse_args()
+
+    if args.trap == 'linkUp':
+        data = encode(LINK_UP, args.if_index, 'up', args.community, args.inform)
+    else:
+        data = encode(LINK_DOWN, args.if_index, 'down', args.community, args.inform)
+
+    host, _, port = args.address.rpartition(':')
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.sendto(data, (host or 'localhost', int(port)))
+    if args.inform:
+        sock.settimeout(5)
+        response, source = sock.recvfrom(65535)
+        print("Received response from %s" % source[0])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import json
+import os
+import tempfile
+import threading
+
+from .log import log
+
+directory = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'vlan-admin')
+
+# Switches are loaded from multiple threads, serialize updating the
+# cache files (see update())
+lock = threading.Lock()
+
+
+def load(name):
+    """
+    Returns the contents of the given JSON cache file, or an empty dict
+    when it does not exist or cannot be read.
+    """
+    try:
+        with open(os.path.join(directory, name + '.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        log("Ignoring unreadable cache file %s: %s" % (name, e))
+        return {}
+
+
+def save(name, data):
+    """
+    Write the given JSON cache file. The file is only readable by the
+    current user, and replaced atomically so readers never see a
+    partially written file.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    filename = os.path.join(directory, name + '.json')
+    # mkstemp creates the file only readable by us, with a unique name
+    # so concurrent writers do not get in each other's way
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def update(name, key, value):
+    """
+    Set a single key in the given JSON cache file, keeping the other
+    keys. Raises OSError when the file cannot be written.
+    """
+    with lock:
+        data = load(name)
+        data[key] = value
+        save(name, data)
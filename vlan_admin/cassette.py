@@ -0,0 +1,268 @@
+"""
+Recording and replaying the requests sent to switches, so performance
+and correctness can be checked against real-world captures without
+access to the switches themselves.
+
+A cassette is a gzipped file with one JSON line per request: the kind
+of request, its key (e.g. the path or the OIDs requested), how long it
+took, and the response (or the exception raised). The first line holds
+the model and the configuration of the switch, with any passwords and
+communities replaced.
+
+When replaying, the response recorded for the same request is returned
+after waiting for the recorded time multiplied by the speed factor (0
+for no delay at all). Identical requests get their recorded responses
+in order, repeating the last one when the recording runs out, so e.g.
+the status can be retrieved more often than it was recorded.
+
+Running this module replays a cassette to time retrieving the switch
+status:
+
+    python -m vlan_admin.cassette core.cassette.gz --speed 0.5 --repeat 10
+"""
+
+import argparse
+import atexit
+import collections
+import gzip
+import importlib
+import json
+import os
+import statistics
+import threading
+import time
+import urllib.error
+
+VERSION = 1
+
+# Config options that are replaced in recorded cassettes
+SECRET_OPTIONS = {'password', 'community', 'privpassword', 'trap_community'}
+
+# Maps files recorded to by this process to the cassette that last
+# recorded to it
+_recorded = {}
+
+
+class CassetteError(Exception):
+    pass
+
+
+def encode_value(value):
+    """
+    Returns the given response value (as returned by the backends, so
+    containing ints, strings, bytes, OIDs and lists or tuples of these)
+    as a JSON-compatible value.
+    """
+    if isinstance(value, bytes):
+        try:
+            # Most responses are text (e.g. HTML pages or names)
+            return {'u': value.decode()}
+        except UnicodeDecodeError:
+            return {'x': value.hex()}
+    elif isinstance(value, tuple):
+        if value and all(type(v) is int for v in value):
+            return {'o': '.'.join(str(v) for v in value)}
+        return {'t': [encode_value(v) for v in value]}
+    elif isinstance(value, list):
+        return [encode_value(v) for v in value]
+    elif value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    raise TypeError("Cannot record value of type %s: %r" % (type(value).__name__, value))
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        if 'u' in value:
+            return value['u'].encode()
+        elif 'x' in value:
+            return bytes.fromhex(value['x'])
+        elif 'o' in value:
+            return tuple(int(v) for v in value['o'].split('.'))
+        else:
+            return tuple(decode_value(v) for v in value['t'])
+    elif isinstance(value, list):
+        return [decode_value(v) for v in value]
+    return value
+
+
+def encode_error(error):
+    if isinstance(error, urllib.error.HTTPError):
+        args = [error.url, error.code, error.msg, None, None]
+    else:
+        args = [str(arg) for arg in error.args]
+    return [type(error).__module__, type(error).__qualname__, args]
+
+
+def decode_error(error):
+    module, name, args = error
+    try:
+        cls = getattr(importlib.import_module(module), name)
+        return cls(*args)
+    except Exception:
+        return CassetteError("%s.%s: %s" % (module, name, ', '.join(str(arg) for arg in args)))
+
+
+class Cassette(object):
+    """
+    Records requests to a file (see record()) or replays them from a
+    file (see play()). Switches route their requests through call().
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        # When replaying, maps (kind, key) to a deque of recorded
+        # (duration, response, error) tuples
+        self.recorded = None
+        self.speed = 1
+        self.header = None
+
+    @classmethod
+    def record(cls, filename, config):
+        """
+        Returns a cassette that records to the given file, for a switch
+        with the given config section.
+        """
+        cassette = cls()
+        cassette.header = {
+            'version': VERSION,
+            'name': config.name,
+            'config': {key: '********' if key in SECRET_OPTIONS else value
+                       for key, value in config.items() if isinstance(value, str)},
+        }
+        # When a switch is created again (e.g. after switching to
+        # another one in the interface), add to what was recorded
+        # before
+        if filename in _recorded:
+            _recorded[filename].close()
+            cassette.file = gzip.open(filename, 'at')
+        else:
+            cassette.file = gzip.open(filename, 'wt')
+        _recorded[filename] = cassette
+        cassette.file.write(json.dumps(cassette.header) + '\n')
+        # The file is only complete when closed
+        atexit.register(cassette.close)
+        return cassette
+
+    @classmethod
+    def play(cls, filename, speed=1):
+        """
+        Returns a cassette that replays the given file, with the
+        recorded durations multiplied by speed.
+        """
+        cassette = cls()
+        cassette.speed = speed
+        cassette.recorded = collections.defaultdict(collections.deque)
+        with gzip.open(filename, 'rt') as f:
+            try:
+                cassette.header = json.loads(f.readline())
+                if cassette.header.get('version') != VERSION:
+                    raise CassetteError("Unsupported cassette version in %s: %s" % (
+                        filename, cassette.header.get('version')))
+                for line in f:
+                    entry = json.loads(line)
+                    if isinstance(entry, dict):
+                        # Header of a later recording
+                        continue
+                    kind, key, duration, response, error = entry
+                    cassette.recorded[(kind, json.dumps(key))].append((duration, response, error))
+            except (EOFError, ValueError) as e:
+                # Recording was interrupted, use what is there
+                if cassette.header is None:
+                    raise CassetteError("Cannot read cassette %s: %s" % (filename, e))
+        return cassette
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+    def call(self, kind, key, fn):
+        """
+        Returns the result of fn(), which does a request of the given
+        kind (e.g. 'GET') with the given key (a JSON-compatible value
+        that identifies the request). When recording, the request and
+        its result (or exception) are recorded. When replaying, fn is
+        not called, the recorded result is returned instead.
+        """
+        if self.recorded is not None:
+            return self.replay(kind, key)
+
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as e:
+            self.write(kind, key, time.perf_counter() - start, None, encode_error(e))
+            raise
+        self.write(kind, key, time.perf_counter() - start, encode_value(result), None)
+        return result
+
+    def write(self, kind, key, duration, response, error):
+        line = json.dumps([kind, key, round(duration, 6), response, error], separators=(',', ':')) + '\n'
+        with self.lock:
+            if self.file:
+                self.file.write(line)
+
+    def replay(self, kind, key):
+        with self.lock:
+            recorded = self.recorded.get((kind, json.dumps(key)))
+            if not recorded:
+                raise CassetteError("No recorded response for %s %s" % (kind, json.dumps(key)))
+            # Keep the last response, to repeat it
+            duration, response, error = recorded.popleft() if len(recorded) > 1 else recorded[0]
+
+        if self.speed:
+            time.sleep(duration * self.speed)
+        if error is not None:
+            raise decode_error(error)
+        return decode_value(response)
+
+
+def filename(directory, name):
+    return os.path.join(directory, name + '.cassette.gz')
+
+
+def main():
+    # Imported here, since this imports all of the interface
+    import configobj
+    from .main import switch_constructor
+
+    parser = argparse.ArgumentParser(description="Replay a cassette, timing retrieving the switch status")
+    parser.add_argument('cassette')
+    parser.add_argument(
+        '--speed', type=float, default=1, metavar='FACTOR',
+        help="Multiply the recorded duration of each request by FACTOR, 0 for no delay (default: %(default)s)",
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5, metavar='N',
+        help="Number of times to retrieve the status (default: %(default)s)",
+    )
+    args = parser.parse_args()
+
+    cassette = Cassette.play(args.cassette, args.speed)
+    name = cassette.header['name']
+    config = configobj.ConfigObj({name: cassette.header['config']})[name]
+    # Nothing is sent to the switch, but the address might not
+    # resolve here
+    config['address'] = '127.0.0.1'
+    # Using the SNMPv3 key cache needs requests that might not be
+    # recorded
+    config.pop('cache_keys', None)
+    switch = switch_constructor(config)()
+    switch.cassette = cassette
+
+    durations = []
+    for i in range(args.repeat):
+        start = time.perf_counter()
+        switch.get_status()
+        durations.append(time.perf_counter() - start)
+        switch.deliver_deferred_signals()
+
+    print("%s: %d ports, %d vlans" % (name, len(switch.ports), len(switch.vlans)))
+    print("get_status: mean %.3fs, median %.3fs, max %.3fs" % (
+        statistics.mean(durations), statistics.median(durations), max(durations)))
+    print("%d requests, %.3fs total" % (switch.stats.total.count, switch.stats.total.duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+import array
+
+# The port counters that are sampled, with their width in bits. Backends
+# return values in this order.
+COUNTERS = [
+    ('in_octets', 64),
+    ('out_octets', 64),
+    ('in_errors', 32),
+    ('out_errors', 32),
+    ('in_discards', 32),
+    ('out_discards', 32),
+]
+
+
+class RingBuffer(object):
+    """
+    Fixed-size buffer of numbers, backed by an array (so a sample costs
+    just the size of the number, not of a Python object). When full,
+    adding a value overwrites the oldest one.
+    """
+    def __init__(self, typecode, size):
+        self.values = array.array(typecode, bytes(array.array(typecode).itemsize * size))
+        self.size = size
+        self.count = 0
+        # Index where the next value goes
+        self.next = 0
+
+    def append(self, value):
+        self.values[self.next] = value
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        """
+        Returns the i-th oldest value (or, for negative i, counted from
+        the newest).
+        """
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.values[(self.next - self.count + i) % self.size]
+
+    def __iter__(self):
+        return (self[i] for i in range(self.count))
+
+
+class PortCounters(object):
+    """
+    History of the counter samples of a single port, keeping at most
+    size samples.
+    """
+    def __init__(self, size):
+        self.times = RingBuffer('d', size)
+        self.counters = [RingBuffer('Q', size) for name, bits in COUNTERS]
+
+    def add(self, timestamp, values):
+        self.times.append(timestamp)
+        for buf, value in zip(self.counters, values):
+            buf.append(value)
+
+    def rates(self):
+        """
+        Returns a dict mapping counter names to their increase per
+        second between the last two samples, or None when there are not
+        enough samples yet. Counters that went down are assumed to have
+        wrapped, except for 64-bit counters, which do not wrap in
+        practice, so they must have been reset (e.g. by a reboot). The
+        rate is None for those.
+        """
+        if len(self.times) < 2:
+            return None
+
+        elapsed = self.times[-1] - self.times[-2]
+        if elapsed <= 0:
+            return None
+
+        rates = {}
+        for (name, bits), buf in zip(COUNTERS, self.counters):
+            delta = buf[-1] - buf[-2]
+            if delta < 0 and bits == 64:
+                rates[name] = None
+            else:
+                rates[name] = (delta % 2 ** bits) / elapsed
+        return rates
+
+    def history(self):
+        """
+        Returns all samples, oldest first, as (timestamp, values) tuples.
+        """
+        return [(self.times[i], [buf[i] for buf in self.counters]) for i in range(len(self.times))]
+
+
+def format_bits(rate):
+    """
+    Format a rate in bytes per second as bits per second.
+    """
+    if rate is None:
+        return "?"
+    rate *= 8
+    for unit in ['bit/s', 'kbit/s', 'Mbit/s']:
+        if rate < 1000:
+            return "%.1f %s" % (rate, unit)
+        rate /= 1000
+    return "%.1f Gbit/s" % rate
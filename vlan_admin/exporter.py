@@ -0,0 +1,239 @@
+"""
+Exports the port and vlan state of all configured switches as metrics
+in the Prometheus text exposition format, so they can be monitored
+without another collector talking to the switches.
+
+All switches are loaded concurrently every interval, after which the
+metrics are written to a file (e.g. for the textfile collector of the
+node exporter) and/or served over HTTP at /metrics. Scrapes are always
+answered from the metrics of the last load, so they never cause any
+traffic to the switches.
+"""
+
+import concurrent.futures
+import http.server
+import os
+import re
+import threading
+import time
+
+from .backends.common import Vlan
+from .log import flush_deferred, log
+
+# Metric families, in the order they are written, with their type and
+# help text
+METRICS = [
+    ('vlan_admin_load_success', 'gauge', "Whether the last load of the switch succeeded"),
+    ('vlan_admin_load_duration_seconds', 'gauge', "Time taken by the last load of the switch"),
+    ('vlan_admin_load_timestamp_seconds', 'gauge', "Time the last load of the switch finished"),
+    ('vlan_admin_vlans', 'gauge', "Number of vlans configured on the switch"),
+    ('vlan_admin_port_up', 'gauge', "Whether the link of the port is up"),
+    ('vlan_admin_port_speed_mbps', 'gauge', "Speed of the link of the port, when known"),
+    ('vlan_admin_port_pvid', 'gauge', "Vlan id assigned to untagged packets received on the port"),
+    ('vlan_admin_port_vlans', 'gauge', "Number of vlans the port is a member of"),
+    ('vlan_admin_vlan_ports', 'gauge', "Number of ports that are a member of the vlan"),
+]
+
+MEMBERSHIP_NAMES = {Vlan.TAGGED: 'tagged', Vlan.UNTAGGED: 'untagged'}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def sample(name, labels, value):
+    """
+    Returns a (metric name, line) tuple for a single sample.
+    """
+    label_text = ','.join('%s="%s"' % (label, escape(v)) for label, v in labels.items())
+    return name, '%s{%s} %s' % (name, label_text, value)
+
+
+def link_speed(link_status):
+    """
+    Returns the speed in Mbit/s in a link status (e.g. "1000M" or
+    "100M Full"), or None when it does not contain one.
+    """
+    match = re.match(r'(\d+)\s*([MG])', link_status or '')
+    if not match:
+        return None
+    return int(match.group(1)) * (1000 if match.group(2) == 'G' else 1)
+
+
+def switch_samples(name, switch):
+    """
+    Returns the samples describing the given loaded switch.
+    """
+    samples = [sample('vlan_admin_vlans', {'switch': name}, len(switch.vlans))]
+
+    port_counts = {port: {m: 0 for m in MEMBERSHIP_NAMES} for port in switch.ports}
+    for vlan in switch.vlans:
+        vlan_counts = {m: 0 for m in MEMBERSHIP_NAMES}
+        for port, membership in vlan.ports.items():
+            if membership in MEMBERSHIP_NAMES and port in port_counts:
+                vlan_counts[membership] += 1
+                port_counts[port][membership] += 1
+        for membership, count in vlan_counts.items():
+            labels = {'switch': name, 'vlan': vlan.dotq_id, 'membership': MEMBERSHIP_NAMES[membership]}
+            samples.append(sample('vlan_admin_vlan_ports', labels, count))
+
+    for port in switch.ports:
+        labels = {'switch': name, 'port': port.num}
+        link_status = getattr(port, 'link_status', None)
+        samples.append(sample('vlan_admin_port_up', labels, int(link_status is not None and port.up)))
+        speed = link_speed(link_status)
+        if speed is not None:
+            samples.append(sample('vlan_admin_port_speed_mbps', labels, speed))
+        samples.append(sample('vlan_admin_port_pvid', labels, port.pvid))
+        for membership, count in port_counts[port].items():
+            labels = {'switch': name, 'port': port.num, 'membership': MEMBERSHIP_NAMES[membership]}
+            samples.append(sample('vlan_admin_port_vlans', labels, count))
+    return samples
+
+
+def render(samples):
+    """
+    Returns the given samples as text, grouped per metric.
+    """
+    by_name = {name: [] for name, kind, help in METRICS}
+    for name, line in samples:
+        by_name[name].append(line)
+
+    lines = []
+    for name, kind, help in METRICS:
+        if by_name[name]:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.extend(by_name[name])
+    return ''.join(line + '\n' for line in lines)
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    # Set on the subclass created by Exporter
+    exporter = None
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.exporter.metrics
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to log
+        pass
+
+
+class Exporter(object):
+    """
+    Loads the given switches (constructors mapping switch name to
+    constructor) every interval seconds, at most concurrency at the
+    same time, and publishes their metrics to filename and/or over
+    HTTP on the given (host, port) address.
+    """
+    def __init__(self, constructors, interval, filename=None, address=None, concurrency=8):
+        self.constructors = constructors
+        self.interval = interval
+        self.filename = filename
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        # Switches are kept between loads (and reloaded in place), so
+        # they keep their sessions
+        self.switches = {}
+        self.lock = threading.Lock()
+        # Samples of the last load of each switch
+        self.samples = {}
+        # The rendered metrics, as bytes
+        self.metrics = b''
+        # Futures of the loads in progress
+        self.futures = []
+
+        self.httpd = None
+        if address:
+            handler = type('Handler', (MetricsHandler,), {'exporter': self})
+            self.httpd = http.server.ThreadingHTTPServer(address, handler)
+
+    def load(self, name):
+        # Called in a worker thread
+        with self.lock:
+            switch = self.switches.get(name)
+        if switch is None:
+            switch = self.constructors[name]()
+            with self.lock:
+                self.switches[name] = switch
+        start = time.monotonic()
+        try:
+            switch.get_status()
+            samples = switch_samples(name, switch)
+        finally:
+            # The FS726T only allows a single login, so do not stay
+            # logged in between loads
+            switch.do_logout()
+        return samples, time.monotonic() - start
+
+    def update(self):
+        """
+        Load all switches and publish their metrics.
+        """
+        futures = {self.executor.submit(self.load, name): name for name in self.constructors}
+        self.futures = list(futures)
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=0.1)
+            # Show progress logged by the workers
+            flush_deferred()
+
+        for future, name in futures.items():
+            labels = {'switch': name}
+            try:
+                samples, duration = future.result()
+            except Exception as e:
+                log("Loading %s failed: %s" % (name, e))
+                samples = [sample('vlan_admin_load_success', labels, 0)]
+            else:
+                samples = [
+                    sample('vlan_admin_load_success', labels, 1),
+                    sample('vlan_admin_load_duration_seconds', labels, '%.3f' % duration),
+                    sample('vlan_admin_load_timestamp_seconds', labels, '%.3f' % time.time()),
+                ] + samples
+            self.samples[name] = samples
+
+        # Nothing is connected to the signals of the switches, but do
+        # not let them pile up (failed loads emit signals as well)
+        with self.lock:
+            switches = list(self.switches.values())
+        for switch in switches:
+            switch.deliver_deferred_signals()
+
+        self.metrics = render([s for samples in self.samples.values() for s in samples]).encode()
+        if self.filename:
+            # Write atomically, so readers never see a partial file
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(self.metrics)
+            os.replace(tmp, self.filename)
+
+    def run(self):
+        if self.httpd:
+            host, port = self.httpd.server_address[:2]
+            log("Serving metrics on http://%s:%d/metrics" % (host, port))
+            threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        try:
+            while True:
+                start = time.monotonic()
+                self.update()
+                log("Loaded %d switches in %.1fs" % (len(self.constructors), time.monotonic() - start))
+                time.sleep(max(0, start + self.interval - time.monotonic()))
+        finally:
+            if self.httpd:
+                self.httpd.shutdown()
+                self.httpd.server_close()
+            # shutdown() only cancels pending work itself since Python
+            # 3.9
+            for future in self.futures:
+                future.cancel()
+            self.executor.shutdown(wait=True)
+            flush_deferred()
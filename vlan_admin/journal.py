@@ -0,0 +1,236 @@
+"""
+Journal of the unsaved changes of a switch, so they can be recovered
+when the tool is interrupted (e.g. when the terminal is closed) or quit
+without committing.
+
+Every change queued is appended to the journal file of the switch as
+one JSON line, in the compact form of Switch.encode_change(). Lines are
+flushed right away, but not synced to disk, which would make editing
+noticeably slower. Since changes that cancel each other out keep
+growing the journal, it is rewritten to just the list of unsaved
+changes once it gets much longer than that list. When there are no
+unsaved changes, the journal file is removed.
+"""
+
+import contextlib
+import json
+import os
+import urllib.parse
+
+import urwid
+
+from . import cache
+from .backends.common import (AddVlanChange, DeleteVlanChange, PortDescriptionChange, PortPVIDChange,
+                              PortVlanMembershipChange, VlanNameChange)
+from .log import log
+
+directory = os.path.join(cache.directory, 'journal')
+
+CHANGE_TYPES = {cls.__name__: cls for cls in [
+    AddVlanChange, DeleteVlanChange, PortDescriptionChange, PortPVIDChange, PortVlanMembershipChange, VlanNameChange,
+]}
+
+
+def filename(name):
+    # Config section names can contain anything, including slashes
+    return os.path.join(directory, urllib.parse.quote(name, safe=' ') + '.jsonl')
+
+
+def to_json(record):
+    """
+    Returns the given record as a JSON-compatible list, starting with
+    the name of the change type.
+    """
+    kind = record[0]
+    fields = list(record[1:])
+    if kind is DeleteVlanChange:
+        # Memberships as a string of digits
+        fields[-1] = ''.join(str(m) for m in fields[-1])
+    return [kind.__name__] + fields
+
+
+def from_json(fields):
+    """
+    Inverse of to_json(). Raises KeyError, IndexError or ValueError
+    when fields is not a valid record.
+    """
+    kind = CHANGE_TYPES[fields[0]]
+    fields = list(fields[1:])
+    if kind is DeleteVlanChange:
+        fields[-1] = bytes(int(m) for m in fields[-1])
+    return (kind,) + tuple(fields)
+
+
+def encode(record):
+    return json.dumps(to_json(record)) + '\n'
+
+
+def decode(line):
+    return from_json(json.loads(line))
+
+
+def load(name):
+    """
+    Returns the records in the journal of the switch with the given
+    (config section) name, or an empty list when there is none.
+    """
+    records = []
+    try:
+        with open(filename(name)) as f:
+            for line in f:
+                try:
+                    records.append(decode(line))
+                except (ValueError, KeyError, IndexError):
+                    # Most likely the last line, when interrupted while
+                    # writing it
+                    log("Ignoring invalid line in journal of %s: %r" % (name, line))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        log("Cannot read journal of %s: %s" % (name, e))
+    return records
+
+
+def expected_values(records):
+    """
+    Returns a dict with the values the switch should have for the
+    given records to apply, mapping (attribute, port number and/or vlan
+    id) to the value, and ('vlan', id) to whether the vlan should exist.
+    """
+    expected = {}
+    for record in records:
+        kind = record[0]
+        # Only the first record for everything matters, later records
+        # expect the value set by an earlier one
+        if kind is PortVlanMembershipChange:
+            expected.setdefault(('membership', record[1], record[2]), record[-1])
+            expected.setdefault(('vlan', record[2]), True)
+        elif kind is PortPVIDChange:
+            expected.setdefault(('pvid', record[1]), record[-1])
+        elif kind is PortDescriptionChange:
+            expected.setdefault(('description', record[1]), record[-1])
+        elif kind is VlanNameChange:
+            expected.setdefault(('name', record[1]), record[-1])
+            expected.setdefault(('vlan', record[1]), True)
+        else:
+            expected.setdefault(('vlan', record[1]), kind is DeleteVlanChange)
+    return expected
+
+
+def current_value(switch, key):
+    ports = {port.num: port for port in switch.ports}
+    what = key[0]
+    if what == 'vlan':
+        return key[1] in switch.dotq_vlans
+    elif what in ('pvid', 'description'):
+        return getattr(ports[key[1]], what) if key[1] in ports else None
+    elif what == 'name':
+        return switch.dotq_vlans[key[1]].name if key[1] in switch.dotq_vlans else None
+    else:
+        port, vlan = ports.get(key[1]), switch.dotq_vlans.get(key[2])
+        return vlan.ports[port] if port and vlan else None
+
+
+def conflicts(switch, records):
+    """
+    Check whether the given records still apply to the (freshly loaded)
+    switch. Returns a list of descriptions of the conflicts: everything
+    that was changed on the switch in the meantime.
+    """
+    expected = expected_values(records)
+    result = []
+    for key, value in expected.items():
+        # Memberships and the name of vlans that are added by the
+        # journal cannot be checked
+        if key[0] in ('membership', 'name') and not expected[('vlan', key[-1])]:
+            continue
+        actual = current_value(switch, key)
+        if actual != value:
+            if key[0] == 'vlan':
+                result.append("vlan %d %s" % (key[1], "was removed" if value else "was added"))
+            elif key[0] == 'membership':
+                result.append("membership of port %d in vlan %d changed" % key[1:])
+            else:
+                result.append("%s of %s %d changed" % (key[0], 'vlan' if key[0] == 'name' else 'port', key[1]))
+    return result
+
+
+def replay(switch, records):
+    """
+    Queue the changes in the given records on the switch, as a single
+    batch. Records that conflict with the state of the switch at that
+    point are skipped. Returns the number of records skipped.
+    """
+    skipped = 0
+    with switch.batch():
+        for record in records:
+            expected = expected_values([record])
+            if any(current_value(switch, key) != value for key, value in expected.items()):
+                skipped += 1
+            else:
+                switch.apply_record(record)
+    return skipped
+
+
+class Journal(object):
+    """
+    Open journal for the given switch, which should be set as its
+    journal attribute. Any existing journal is replaced by the changes
+    currently queued on the switch (so replay() it first to keep it).
+    """
+
+    # Rewrite the journal when it has more than this many lines, plus
+    # twice the number of unsaved changes
+    slack = 1000
+
+    def __init__(self, switch, name):
+        self.switch = switch
+        self.filename = filename(name)
+        self.file = None
+        self.compact()
+        urwid.connect_signal(switch, 'changelist_changed', self.check)
+
+    def append(self, record):
+        self.file.write(encode(record))
+        self.file.flush()
+        self.lines += 1
+
+    def check(self, switch):
+        """
+        Rewrite the journal when it is much longer than the list of
+        unsaved changes, or empty the journal when that list is (e.g.
+        after committing). Called when the list of unsaved changes
+        changed.
+        """
+        if self.lines > 2 * len(self.switch.changes) + self.slack or (self.lines and not self.switch.changes):
+            self.compact()
+
+    def compact(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        tmp = self.filename + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            for change in self.switch.changes:
+                f.write(encode(self.switch.encode_change(change)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.filename)
+
+        self.lines = len(self.switch.changes)
+        self.file = open(self.filename, 'a')
+
+    def close(self):
+        """
+        Close the journal. It is removed when there are no unsaved
+        changes, otherwise these are offered again next time.
+        """
+        urwid.disconnect_signal(self.switch, 'changelist_changed', self.check)
+        self.file.close()
+        if not self.switch.changes:
+            # It might have been removed by another instance already
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.filename)
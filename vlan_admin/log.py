@@ -1,14 +1,69 @@
+import collections
+import threading
+import time
+
 ui = None
 logfile = None
+# When there is no ui, only write to the logfile instead of printing
+# (e.g. when the output is a report)
+quiet = False
+
+# Flush the logfile at most once per this many seconds. Flushing after
+# every line means a write syscall per logged line, which adds up
+# quickly with verbose (e.g. per-request) logging. Anything still
+# buffered is written out by close().
+flush_interval = 1.0
+_last_flush = 0
+
+# Lines logged from other threads than the main thread, see log()
+_deferred = collections.deque()
 
 
 def log(text):
+    if threading.current_thread() is not threading.main_thread():
+        # urwid is not thread-safe, so lines logged by worker threads
+        # are only shown (and written) when the main thread calls
+        # flush_deferred() or logs something itself.
+        _deferred.append(text)
+        return
+
+    flush_deferred()
+    _write(text)
+
+
+def flush_deferred():
+    """
+    Write out any lines logged by other threads. Does nothing when
+    called from another thread (e.g. by code that runs in the
+    background in the interface), the main thread writes them later.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return
+    while _deferred:
+        _write(_deferred.popleft())
+
+
+def _write(text):
+    global _last_flush
+
     if logfile:
         logfile.write(text + "\n")
-        logfile.flush()
+        now = time.monotonic()
+        if now - _last_flush >= flush_interval:
+            logfile.flush()
+            _last_flush = now
     if ui:
         ui.log(text)
-    else:
+    elif not quiet:
         # Shouldn't normally happen, but this can happen when debugging
         # with write == True
         print(text)
+
+
+def close():
+    global logfile
+
+    flush_deferred()
+    if logfile:
+        logfile.close()
+        logfile = None
@@ -24,6 +24,7 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 
+import argparse
 import io
 import os.path
 import configobj
@@ -31,7 +32,12 @@ import importlib
 import sys
 import validate
 
+from . import cassette
+from . import exporter
 from . import log
+from . import profiling
+from . import server
+from . import trunks
 
 from .ui.main import Interface
 
@@ -81,9 +87,148 @@ def switch_constructor(section):
     return create
 
 
+def with_cassette(constructor, section, args):
+    """
+    Returns a constructor that sets up the cassette to record or replay
+    for the switch created by the given one.
+    """
+    filename = cassette.filename(args.record or args.replay, section.name)
+
+    def create():
+        switch = constructor()
+        if args.record:
+            os.makedirs(args.record, exist_ok=True)
+            switch.cassette = cassette.Cassette.record(filename, section)
+        else:
+            switch.cassette = cassette.Cassette.play(filename, args.replay_speed)
+        return switch
+    return create
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Manage VLANs on Netgear switches")
+    parser.add_argument(
+        '--log-lines', type=int, default=1000, metavar='N',
+        help="Number of lines to keep in the debug log panel (default: %(default)s)",
+    )
+    parser.add_argument(
+        '--stats-file', metavar='FILE',
+        help="On exit, write request timing statistics for all used switches to FILE (as JSON)",
+    )
+    parser.add_argument(
+        '--counters-file', metavar='FILE',
+        help="On exit, write the traffic counters sampled for all used switches to FILE (as CSV)",
+    )
+    parser.add_argument(
+        '--trap-listen', metavar='[HOST:]PORT',
+        help="Listen for SNMP link up/down notifications from the switches on this UDP port",
+    )
+    parser.add_argument(
+        '--keep-switches', type=int, default=4, metavar='N',
+        help="Number of switches to keep loaded (besides the current one) for quick switching "
+             "(default: %(default)s)",
+    )
+    parser.add_argument(
+        '--prefetch', type=int, nargs='?', const=4, metavar='N',
+        help="When multiple switches are configured, start loading all of them in the background right "
+             "away, N at a time (default: %(const)s)",
+    )
+    parser.add_argument(
+        '--check-uplinks', action='store_true',
+        help="Check that the vlans on both ends of all uplinks between the configured switches match, "
+             "print the result and exit",
+    )
+    parser.add_argument(
+        '--serve', metavar='[HOST:]PORT',
+        help="Instead of starting the interface, keep all configured switches loaded and serve their state "
+             "(and accept changes) as JSON over HTTP on this port (on localhost by default)",
+    )
+    parser.add_argument(
+        '--metrics-file', metavar='FILE',
+        help="Instead of starting the interface, periodically load all configured switches and write "
+             "their port and vlan state as Prometheus metrics to FILE",
+    )
+    parser.add_argument(
+        '--metrics-listen', metavar='[HOST:]PORT',
+        help="Like --metrics-file, but serve the metrics over HTTP at /metrics on this port (on localhost "
+             "by default)",
+    )
+    parser.add_argument(
+        '--metrics-interval', type=float, default=60, metavar='SECONDS',
+        help="Interval between loading all switches for --metrics-file and --metrics-listen "
+             "(default: %(default)s)",
+    )
+    parser.add_argument(
+        '--record', metavar='DIR',
+        help="Record all requests sent to each switch, with their responses and timing, to a cassette file "
+             "in DIR",
+    )
+    parser.add_argument(
+        '--replay', metavar='DIR',
+        help="Instead of talking to the switches, replay the cassette files recorded in DIR with --record",
+    )
+    parser.add_argument(
+        '--replay-speed', type=float, default=1, metavar='FACTOR',
+        help="With --replay, multiply the recorded duration of each request by FACTOR, 0 for no delay "
+             "(default: %(default)s)",
+    )
+    parser.add_argument(
+        '--profile', metavar='DIR',
+        help="Profile retrieving switch status, committing changes and building the VLAN/port matrix, "
+             "writing a pstats file for each of these to DIR",
+    )
+    args = parser.parse_args()
+
+    if args.log_lines < 1:
+        parser.error("--log-lines must be at least 1")
+
+    if args.keep_switches < 0:
+        parser.error("--keep-switches cannot be negative")
+
+    if args.prefetch is not None and args.prefetch < 1:
+        parser.error("--prefetch must be at least 1")
+
+    if args.trap_listen:
+        host, _, port = args.trap_listen.rpartition(':')
+        try:
+            args.trap_listen = (host or '0.0.0.0', int(port))
+        except ValueError:
+            parser.error("--trap-listen must be a port number, optionally preceded by HOST:")
+
+    if args.serve:
+        host, _, port = args.serve.rpartition(':')
+        try:
+            args.serve = (host or 'localhost', int(port))
+        except ValueError:
+            parser.error("--serve must be a port number, optionally preceded by HOST:")
+
+    if args.metrics_listen:
+        host, _, port = args.metrics_listen.rpartition(':')
+        try:
+            args.metrics_listen = (host or 'localhost', int(port))
+        except ValueError:
+            parser.error("--metrics-listen must be a port number, optionally preceded by HOST:")
+
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be combined")
+
+    if args.replay_speed < 0:
+        parser.error("--replay-speed cannot be negative")
+
+    if args.metrics_interval <= 0:
+        parser.error("--metrics-interval must be positive")
+
+    return args
+
+
 def main():
+    args = parse_args()
+
     log.logfile = open('vlan-admin.log', 'a')
 
+    if args.profile:
+        profiling.enable(args.profile)
+
     # Create the switch object
     config = configobj.ConfigObj(
         infile=config_filename,
@@ -96,17 +241,54 @@ def main():
     switches = {}
     for name, section in config.items():
         switches[section.name] = switch_constructor(section)
+        if args.record or args.replay:
+            switches[section.name] = with_cassette(switches[section.name], section, args)
 
     if not switches:
         sys.stderr.write(f"No switches configured in config file ({config_filename})\n")
         return
 
+    if args.check_uplinks:
+        log.quiet = True
+        try:
+            lines, created = trunks.check(switches)
+        finally:
+            log.close()
+        print('\n'.join(lines))
+        return
+
+    if args.serve:
+        try:
+            tokens = {section.name: section['api_token'] for section in config.values() if 'api_token' in section}
+            server.Server(switches, args.serve, tokens).serve()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            log.close()
+        return
+
+    if args.metrics_file or args.metrics_listen:
+        try:
+            exporter.Exporter(
+                switches, args.metrics_interval, filename=args.metrics_file, address=args.metrics_listen,
+            ).run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            log.close()
+        return
+
     # Create an interface for the switch
-    ui = Interface(switches)
+    ui = Interface(
+        switches, log_lines=args.log_lines, stats_file=args.stats_file,
+        trap_address=args.trap_listen, keep_switches=args.keep_switches,
+        prefetch=args.prefetch, counters_file=args.counters_file,
+    )
     log.ui = ui
-    ui.start()
-
-    log.logfile.close()
+    try:
+        ui.start()
+    finally:
+        log.close()
 
 
 if __name__ == '__main__':
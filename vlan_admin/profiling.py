@@ -0,0 +1,57 @@
+import contextlib
+import cProfile
+import os
+
+from .log import log
+
+# Directory to write profiles to, or None when profiling is disabled
+directory = None
+
+# Profilers for the phases currently running, innermost last
+_active = []
+_sequence = 0
+
+
+def enable(path):
+    global directory
+
+    os.makedirs(path, exist_ok=True)
+    directory = path
+
+
+@contextlib.contextmanager
+def phase(name):
+    """
+    Context manager that profiles the code inside it as a separate
+    phase, writing the result to a pstats file named after the phase in
+    the profile directory (if profiling is enabled).
+
+    Phases can be nested (e.g. building the matrix while retrieving the
+    switch status), the time spent in an inner phase is then only
+    included in the profile of the inner phase.
+    """
+    global _sequence
+
+    if directory is None:
+        yield
+        return
+
+    _sequence += 1
+    filename = os.path.join(directory, "%03d-%s.prof" % (_sequence, name))
+
+    profiler = cProfile.Profile()
+    if _active:
+        _active[-1].disable()
+    _active.append(profiler)
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        _active.pop()
+
+        profiler.dump_stats(filename)
+        log("Wrote profile for %s to %s" % (name, filename))
+
+        if _active:
+            _active[-1].enable()
@@ -0,0 +1,487 @@
+"""
+Daemon that keeps the configured switches loaded and serves their state
+as JSON over HTTP, so scripts and dashboards can share a single set of
+switch sessions instead of each polling the switches themselves.
+
+Each switch is reloaded every refresh_interval seconds (config option,
+default 300) and its link status is polled every link_poll_interval
+seconds (default 10), or reloaded on demand. All work on a switch is
+done by a single worker thread for that switch; request handlers only
+look at the last published state.
+
+Requests:
+
+    GET /switches
+        The names of all switches, with the ETag and time of their
+        last refresh, and the last error (if any).
+
+    GET /switches/NAME
+        The state of the switch as a snapshot (see snapshot.py),
+        extended with a "link_status" dict mapping port numbers to
+        their link status. Supports If-None-Match.
+
+    POST /switches/NAME/refresh
+        Reload the switch now.
+
+    POST /switches/NAME/changes
+        Queue a change set: a JSON list of records like the ones in
+        the journal (see journal.py), e.g.:
+
+            [["PortVlanMembershipChange", 3, 10, 1, 0],
+             ["PortDescriptionChange", 3, "uplink", ""],
+             ["DeleteVlanChange", 20]]
+
+        The last value of a record is the value the client expects the
+        switch to have now. The changes are applied like in the
+        interface (so making a port untagged also changes its PVID)
+        and committed with commit_all(), after reloading the switch.
+        When the switch no longer has the expected values, nothing is
+        changed. With If-Match, the change set is refused right away
+        when the state of the switch changed. Returns the location of
+        the change set.
+
+    GET /changesets/ID
+        The state of a change set: queued, committing, done, conflict
+        (with a list of conflicts) or failed (with the error).
+
+POST requests must not have an Origin header, so web pages cannot make
+browsers send them, and change sets must be sent as application/json.
+When the section of a switch sets api_token, POST requests for it must
+have an "Authorization: Bearer TOKEN" header. Without api_token, change
+sets are refused (refreshing is still allowed).
+"""
+
+import collections
+import concurrent.futures
+import hashlib
+import hmac
+import http.server
+import itertools
+import json
+import random
+import threading
+import time
+
+from . import journal
+from . import snapshot
+from .backends.common import (AddVlanChange, DeleteVlanChange, PortDescriptionChange, PortPVIDChange,
+                              PortVlanMembershipChange, Vlan, VlanNameChange)
+from .log import flush_deferred, log
+
+# Number of fields in each kind of record
+RECORD_LENGTHS = {
+    AddVlanChange: 2,
+    DeleteVlanChange: 2,
+    PortVlanMembershipChange: 5,
+    PortPVIDChange: 4,
+    PortDescriptionChange: 4,
+    VlanNameChange: 4,
+}
+
+# Number of finished change sets to remember
+finished_changesets = 1000
+
+
+def parse_record(fields):
+    """
+    Returns the record for a change in a change set (as a JSON list).
+    Raises ValueError when it is not valid.
+    """
+    try:
+        if fields[0] == 'DeleteVlanChange':
+            # The name and memberships in journal records are not
+            # needed to delete a vlan
+            record = (DeleteVlanChange, fields[1])
+        else:
+            record = journal.from_json(fields)
+    except (TypeError, KeyError, IndexError, ValueError):
+        raise ValueError("invalid change: %s" % json.dumps(fields))
+
+    kind = record[0]
+    if kind is PortPVIDChange:
+        numbers = record[1:]
+    elif kind is PortVlanMembershipChange:
+        numbers = record[1:3]
+    else:
+        numbers = record[1:2]
+    if len(record) != RECORD_LENGTHS[kind] or not all(isinstance(n, int) for n in numbers):
+        raise ValueError("invalid change: %s" % json.dumps(fields))
+    if kind is PortVlanMembershipChange and not {record[3], record[4]} <= {Vlan.NOTMEMBER, Vlan.TAGGED, Vlan.UNTAGGED}:
+        raise ValueError("invalid membership: %s" % json.dumps(fields))
+    if kind in (PortDescriptionChange, VlanNameChange) and not all(isinstance(v, str) for v in record[2:]):
+        what = 'description' if kind is PortDescriptionChange else 'name'
+        raise ValueError("invalid %s: %s" % (what, json.dumps(fields)))
+    return record
+
+
+def apply_records(switch, records):
+    """
+    Queue the changes in the given records on the switch, as a single
+    batch, through the same methods the interface uses.
+    """
+    ports = {port.num: port for port in switch.ports}
+    with switch.batch():
+        for record in records:
+            kind = record[0]
+            if kind is AddVlanChange:
+                switch.add_vlan(record[1])
+            elif kind is DeleteVlanChange:
+                switch.delete_vlan(switch.dotq_vlans[record[1]])
+            elif kind is PortVlanMembershipChange:
+                switch.dotq_vlans[record[2]].set_port_membership(ports[record[1]], record[3])
+            elif kind is PortPVIDChange:
+                ports[record[1]].pvid = record[2]
+            elif kind is PortDescriptionChange:
+                ports[record[1]].description = record[2]
+            elif kind is VlanNameChange:
+                switch.dotq_vlans[record[1]].name = record[2]
+
+
+class ChangeSet(object):
+    def __init__(self, id, name, records):
+        self.id = id
+        self.name = name
+        self.records = records
+        self.state = 'queued'
+        self.conflicts = []
+        self.error = None
+
+    def to_json(self):
+        data = {'id': self.id, 'switch': self.name, 'state': self.state, 'changes': len(self.records)}
+        if self.conflicts:
+            data['conflicts'] = self.conflicts
+        if self.error:
+            data['error'] = self.error
+        return data
+
+
+class ServedSwitch(object):
+    """
+    A switch kept loaded by the server. All work on the switch model is
+    done by a single worker thread, which publishes the state after
+    every change as JSON, so request handlers never touch the model.
+    """
+    def __init__(self, name, constructor, token=None):
+        self.name = name
+        self.constructor = constructor
+        # Needed for POST requests, see the module docstring
+        self.token = token
+        self.switch = None
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        # The published state, as a (body, etag) tuple, so both are
+        # replaced at once
+        self.published = (None, None)
+        self.refreshed = None
+        self.error = None
+        # Time of the next scheduled refresh and the last link status
+        # poll, as time.monotonic() values
+        self.next_refresh = 0
+        self.last_link_poll = 0
+        # Futures of queued work, see busy. Work is queued by both the
+        # main thread and request handler threads.
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    @property
+    def busy(self):
+        with self.lock:
+            self.futures = {f for f in self.futures if not f.done()}
+            return bool(self.futures)
+
+    def submit(self, fn, *args):
+        with self.lock:
+            future = self.executor.submit(self.run, fn, *args)
+            self.futures.add(future)
+        return future
+
+    def run(self, fn, *args):
+        # Called in the worker thread
+        try:
+            fn(*args)
+        except Exception as e:
+            self.error = "%s failed: %s" % (fn.__name__, e)
+            log("%s: %s" % (self.name, self.error))
+
+    def publish(self):
+        data = snapshot.snapshot(self.switch)
+        data['link_status'] = {str(port.num): getattr(port, 'link_status', None) for port in self.switch.ports}
+        body = json.dumps(data).encode()
+        self.published = (body, '"%s"' % hashlib.sha1(body).hexdigest())
+
+    def refresh(self):
+        # Called in the worker thread
+        if self.switch is None:
+            self.switch = self.constructor()
+            # Nobody can undo anything here
+            self.switch.history.recording = False
+        else:
+            # Left behind by a failed commit
+            self.switch.changes = []
+        start = time.monotonic()
+        self.switch.get_status()
+        self.refreshed = time.time()
+        self.error = None
+        self.publish()
+        log("%s: refreshed in %.1fs" % (self.name, time.monotonic() - start))
+
+    @property
+    def link_poll_interval(self):
+        if self.switch is None or not self.switch.supports_link_polling:
+            return 0
+        return float(self.switch.config.get('link_poll_interval', 10))
+
+    def poll_link_status(self):
+        # Called in the worker thread
+        if self.switch is not None:
+            self.switch.update_link_status(self.switch.get_link_status())
+            self.publish()
+
+    def commit(self, changeset):
+        # Called in the worker thread. Reload first, so the changes are
+        # checked against (and committed on top of) the current state
+        # rather than that of the last refresh.
+        try:
+            self.refresh()
+            changeset.conflicts = journal.conflicts(self.switch, changeset.records)
+            if changeset.conflicts:
+                changeset.state = 'conflict'
+                log("%s: change set %d conflicts: %s" % (self.name, changeset.id, '; '.join(changeset.conflicts)))
+                return
+            changeset.state = 'committing'
+            apply_records(self.switch, changeset.records)
+            if self.switch.changes:
+                self.switch.commit_all()
+            changeset.state = 'done'
+            log("%s: committed change set %d" % (self.name, changeset.id))
+        except Exception as e:
+            changeset.state = 'failed'
+            changeset.error = "%s: %s" % (type(e).__name__, e)
+            log("%s: change set %d failed: %s" % (self.name, changeset.id, e))
+
+        # Publish what is actually on the switch now, which is also
+        # needed to get rid of the changes after a failed commit
+        self.refresh()
+
+    def to_json(self):
+        body, etag = self.published
+        return {'etag': etag, 'refreshed': self.refreshed, 'error': self.error}
+
+    def close(self):
+        # shutdown() only cancels pending work itself since Python 3.9
+        with self.lock:
+            for future in self.futures:
+                future.cancel()
+        self.executor.shutdown(wait=True)
+        if self.switch is not None:
+            self.switch.do_logout()
+
+
+class RequestHandler(http.server.BaseHTTPRequestHandler):
+    # Set on the subclass created by Server
+    server_state = None
+
+    def log_message(self, format, *args):
+        log("%s: %s" % (self.address_string(), format % args))
+
+    def send_json(self, code, data, headers=()):
+        body = data if isinstance(data, bytes) else json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for header in headers:
+            self.send_header(*header)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_error_json(self, code, message):
+        self.send_json(code, {'error': message})
+
+    def parts(self):
+        return [p for p in self.path.split('?', 1)[0].split('/') if p]
+
+    def do_GET(self):
+        server = self.server_state
+        parts = self.parts()
+        if parts == ['switches']:
+            self.send_json(200, {name: served.to_json() for name, served in server.switches.items()})
+        elif len(parts) == 2 and parts[0] == 'switches' and parts[1] in server.switches:
+            served = server.switches[parts[1]]
+            body, etag = served.published
+            if body is None:
+                self.send_error_json(503, served.error or "Not loaded yet")
+            elif etag in self.headers.get('If-None-Match', '').replace(' ', '').split(','):
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.end_headers()
+            else:
+                self.send_json(200, body, [('ETag', etag)])
+        elif len(parts) == 2 and parts[0] == 'changesets' and parts[1].isdigit():
+            changeset = server.changesets.get(int(parts[1]))
+            if changeset is None:
+                self.send_error_json(404, "No such change set")
+            else:
+                self.send_json(200, changeset.to_json())
+        else:
+            self.send_error_json(404, "Not found")
+
+    def authorized(self, served):
+        """
+        Returns whether a POST request for the given switch is allowed,
+        sending an error response when not.
+        """
+        # Browsers add this to requests made by web pages, which should
+        # not be able to change the switches. Other clients do not.
+        if 'Origin' in self.headers:
+            self.send_error_json(403, "Cross-origin requests are not allowed")
+            return False
+        if served.token is not None:
+            scheme, _, token = self.headers.get('Authorization', '').partition(' ')
+            if scheme.lower() != 'bearer' or not hmac.compare_digest(token.strip().encode(), served.token.encode()):
+                self.send_error_json(401, "Invalid or missing token")
+                return False
+        return True
+
+    def read_json(self):
+        """
+        Returns the decoded JSON body of the request. Raises ValueError
+        when there is none.
+        """
+        if self.headers.get_content_type() != 'application/json':
+            raise ValueError("expected Content-Type: application/json")
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            raise ValueError("invalid Content-Length")
+        return json.loads(self.rfile.read(length))
+
+    def do_POST(self):
+        server = self.server_state
+        parts = self.parts()
+        if len(parts) != 3 or parts[0] != 'switches' or parts[1] not in server.switches:
+            self.send_error_json(404, "Not found")
+            return
+
+        served = server.switches[parts[1]]
+        if not self.authorized(served):
+            return
+
+        if parts[2] == 'refresh':
+            server.refresh(served)
+            self.send_json(202, {'refreshing': served.name})
+        elif parts[2] == 'changes':
+            if served.token is None:
+                self.send_error_json(403, "Set api_token in the config of this switch to allow changes")
+                return
+            try:
+                data = self.read_json()
+                if not isinstance(data, list):
+                    raise ValueError("expected a list of changes")
+                records = [parse_record(fields) for fields in data]
+            except ValueError as e:
+                self.send_error_json(400, str(e))
+                return
+
+            if_match = self.headers.get('If-Match')
+            if if_match is not None and if_match != served.published[1]:
+                self.send_error_json(412, "Switch state changed")
+                return
+
+            changeset = server.queue_changeset(served, records)
+            location = '/changesets/%d' % changeset.id
+            self.send_json(202, changeset.to_json(), [('Location', location)])
+        else:
+            self.send_error_json(404, "Not found")
+
+
+class Server(object):
+    """
+    Serves the given switches (constructors mapping switch name to
+    constructor) on the given (host, port) address. tokens maps switch
+    names to their api_token, see the module docstring.
+    """
+    def __init__(self, constructors, address, tokens=None):
+        tokens = tokens or {}
+        self.switches = {name: ServedSwitch(name, constructor, tokens.get(name))
+                         for name, constructor in constructors.items()}
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.changesets = {}
+        # Change sets in the order they were queued
+        self.order = collections.deque()
+        # Refreshes requested by clients, handled by the main thread
+        self.refresh_requests = collections.deque()
+
+        handler = type('Handler', (RequestHandler,), {'server_state': self})
+        self.httpd = http.server.ThreadingHTTPServer(address, handler)
+
+    def refresh(self, served):
+        # Called from request handler threads
+        self.refresh_requests.append(served)
+
+    def queue_changeset(self, served, records):
+        # Called from request handler threads
+        with self.lock:
+            changeset = ChangeSet(next(self.ids), served.name, records)
+            self.changesets[changeset.id] = changeset
+            self.order.append(changeset)
+            # Forget the oldest change sets (these are finished by now,
+            # the worker handles them in order)
+            while len(self.order) > finished_changesets:
+                old = self.order.popleft()
+                if old.state not in ('queued', 'committing'):
+                    del self.changesets[old.id]
+                else:
+                    self.order.appendleft(old)
+                    break
+        served.submit(served.commit, changeset)
+        return changeset
+
+    def tick(self):
+        """
+        Start the refreshes and link status polls that are due, and
+        deliver what the worker threads logged.
+        """
+        flush_deferred()
+        now = time.monotonic()
+        requested = set()
+        while self.refresh_requests:
+            requested.add(self.refresh_requests.popleft())
+
+        for served in self.switches.values():
+            if served.busy:
+                # Refreshing when idle again is soon enough
+                if served in requested:
+                    self.refresh_requests.append(served)
+                continue
+            if served.switch is not None:
+                # Nothing is connected to the signals of the switch,
+                # but do not let them pile up
+                served.switch.deliver_deferred_signals()
+
+            if served in requested or now >= served.next_refresh:
+                served.submit(served.refresh)
+                interval = float(served.switch.config.get('refresh_interval', 300)) if served.switch else 300
+                # Spread the refreshes of different switches a bit
+                served.next_refresh = now + interval * random.uniform(0.9, 1.1)
+                served.last_link_poll = now
+            elif served.link_poll_interval > 0 and now >= served.last_link_poll + served.link_poll_interval:
+                served.submit(served.poll_link_status)
+                served.last_link_poll = now
+
+    def serve(self):
+        host, port = self.httpd.server_address[:2]
+        log("Serving %d switches on http://%s:%d/" % (len(self.switches), host, port))
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        try:
+            while True:
+                self.tick()
+                time.sleep(0.2)
+        finally:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            for served in self.switches.values():
+                served.close()
+            flush_deferred()
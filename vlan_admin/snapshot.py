@@ -0,0 +1,148 @@
+"""
+Snapshots of the configuration of a switch, and comparing them.
+
+A snapshot is a JSON-compatible dict, with the memberships of each vlan
+encoded as a string with one character per port (in the order of the
+"ports" list), so snapshots stay small and can be compared quickly
+even for switches with thousands of vlans.
+
+Running this module compares two snapshot files:
+
+    python -m vlan_admin.snapshot yesterday.json today.json
+"""
+
+import argparse
+import json
+
+from .backends.common import (AddVlanChange, DeleteVlanChange, Port, PortDescriptionChange, PortPVIDChange,
+                              PortVlanMembershipChange, Vlan, VlanNameChange)
+
+VERSION = 1
+
+# Characters used to encode memberships
+MEMBERSHIP_CHARS = {Vlan.NOTMEMBER: '-', Vlan.TAGGED: 'T', Vlan.UNTAGGED: 'U'}
+CHAR_MEMBERSHIPS = {c: m for m, c in MEMBERSHIP_CHARS.items()}
+
+
+def snapshot(switch):
+    """
+    Returns a snapshot of the current state of the given (loaded)
+    switch, including any unsaved changes.
+    """
+    return {
+        'version': VERSION,
+        'switch': {attr: str(getattr(switch, attr))
+                   for column in switch.switch_attrs for (label, attr, edit) in column},
+        'ports': [[port.num, port.description, port.pvid] for port in switch.ports],
+        'vlans': {
+            str(vlan.dotq_id): [vlan.name, ''.join(MEMBERSHIP_CHARS[vlan.ports[port]] for port in switch.ports)]
+            for vlan in switch.vlans
+        },
+    }
+
+
+def save(data, filename):
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=1)
+
+
+def load(filename):
+    with open(filename) as f:
+        data = json.load(f)
+    if data.get('version') != VERSION:
+        raise ValueError("Unsupported snapshot version in %s: %s" % (filename, data.get('version')))
+    return data
+
+
+def diff(old, new, switch=None):
+    """
+    Compare two snapshots, returning a list of Change objects that turn
+    the old state into the new one. This runs in time linear in the
+    size of the snapshots. Switch attributes are not compared, since
+    these cannot be changed.
+
+    When switch is given, the changes refer to its ports and vlans
+    (where they exist), so they can be shown like the unsaved changes
+    of that switch. Otherwise, detached Port and Vlan objects are used.
+    Either way, the changes can be applied to a switch with
+    Switch.apply_changes().
+    """
+    changes = []
+
+    old_ports = {num: (i, description, pvid) for i, (num, description, pvid) in enumerate(old['ports'])}
+    new_ports = {num: (i, description, pvid) for i, (num, description, pvid) in enumerate(new['ports'])}
+    port_objects = {port.num: port for port in switch.ports} if switch is not None else {}
+
+    def get_port(num):
+        if num not in port_objects:
+            i, description, pvid = new_ports[num]
+            port_objects[num] = Port(None, num, description, pvid)
+        return port_objects[num]
+
+    def get_vlan(dotq_id, name):
+        if switch is not None and dotq_id in switch.dotq_vlans:
+            return switch.dotq_vlans[dotq_id]
+        return Vlan(None, None, dotq_id, name)
+
+    # Ports present in both snapshots, with their position in each
+    common = [(num, old_ports[num][0], i) for num, (i, description, pvid) in new_ports.items() if num in old_ports]
+    same_order = len(common) == len(old_ports) == len(new_ports) and all(o == n for num, o, n in common)
+
+    def membership_changes(vlan, old_members, new_members):
+        # When the port lists match, identical memberships (the common
+        # case) can be skipped with a single string comparison
+        if same_order and old_members == new_members:
+            return
+        for num, o, n in common:
+            if old_members[o] != new_members[n]:
+                changes.append(PortVlanMembershipChange(
+                    (get_port(num), vlan), CHAR_MEMBERSHIPS[new_members[n]], CHAR_MEMBERSHIPS[old_members[o]]))
+
+    old_vlans = old['vlans']
+    for key, (name, members) in new['vlans'].items():
+        if key not in old_vlans:
+            vlan = get_vlan(int(key), name)
+            changes.append(AddVlanChange(vlan, None, None))
+            membership_changes(vlan, '-' * len(old_ports), members)
+            if name:
+                changes.append(VlanNameChange(vlan, name, ''))
+            continue
+
+        old_name, old_members = old_vlans[key]
+        if old_name == name and old_members == members and same_order:
+            continue
+        vlan = get_vlan(int(key), name)
+        if old_name != name:
+            changes.append(VlanNameChange(vlan, name, old_name))
+        membership_changes(vlan, old_members, members)
+
+    for num, o, n in common:
+        i, old_description, old_pvid = old_ports[num]
+        i, description, pvid = new_ports[num]
+        if old_description != description:
+            changes.append(PortDescriptionChange(get_port(num), description, old_description))
+        if old_pvid != pvid:
+            changes.append(PortPVIDChange(get_port(num), pvid, old_pvid))
+
+    for key, (name, members) in old_vlans.items():
+        if key not in new['vlans']:
+            changes.append(DeleteVlanChange(get_vlan(int(key), name), None, None))
+
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show the differences between two switch snapshots")
+    parser.add_argument('old')
+    parser.add_argument('new')
+    args = parser.parse_args()
+
+    changes = diff(load(args.old), load(args.new))
+    for change in changes:
+        print(change)
+    if not changes:
+        print("No differences")
+
+
+if __name__ == '__main__':
+    main()
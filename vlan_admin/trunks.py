@@ -0,0 +1,238 @@
+"""
+Checks the vlan configuration on both ends of uplinks between switches.
+
+Uplinks are taken from the "uplinks" option of each switch section,
+e.g.:
+
+    uplinks = 49=core:1, 50=access-2:50
+
+(meaning port 49 of this switch connects to port 1 of the switch in
+section "core" and so on), and learned through LLDP from switches that
+support it.
+"""
+
+import concurrent.futures
+import threading
+
+from .backends.common import MacTable, Vlan
+from .log import flush_deferred, log
+
+
+class Link(object):
+    """
+    A link between two (switch name, port number) ends.
+    """
+    def __init__(self, a, b, source):
+        self.a = a
+        self.b = b
+        self.source = source
+
+    @property
+    def key(self):
+        return frozenset([self.a, self.b])
+
+    def __str__(self):
+        return "%s port %s <-> %s port %s (%s)" % (self.a + self.b + (self.source,))
+
+
+class SwitchLoader(object):
+    """
+    Loads switches and their LLDP neighbors concurrently, loading each
+    switch at most once no matter how often it is asked for. Switches
+    that are already loaded can be passed in loaded (mapping name to
+    switch), only their neighbors are then retrieved.
+    """
+    def __init__(self, constructors, loaded=None, concurrency=8):
+        self.constructors = constructors
+        self.loaded = loaded or {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        self.lock = threading.Lock()
+        # Maps switch name to a Future for a (switch, neighbors) tuple
+        self.futures = {}
+        # Switches created by us, to be logged out by close()
+        self.created = []
+
+    def _load(self, name):
+        switch = self.loaded.get(name)
+        if switch is None:
+            switch = self.constructors[name]()
+            with self.lock:
+                self.created.append(switch)
+            switch.get_status()
+
+        neighbors = switch.get_lldp_neighbors() if switch.supports_lldp else []
+        return switch, neighbors
+
+    def load(self, name):
+        """
+        Returns a Future for the loaded switch with the given name and
+        its LLDP neighbors (an empty list when it does not support
+        LLDP), as a (switch, neighbors) tuple.
+        """
+        with self.lock:
+            if name not in self.futures:
+                self.futures[name] = self.executor.submit(self._load, name)
+            return self.futures[name]
+
+    def close(self):
+        """
+        Log out of all switches created by this loader. Returns these
+        switches.
+        """
+        self.executor.shutdown(wait=True)
+        for switch in self.created:
+            switch.do_logout()
+        return self.created
+
+
+def configured_links(switches):
+    """
+    Returns the links listed in the uplinks option of the config
+    sections of the given switches (mapping name to switch).
+    """
+    links = []
+    for name, switch in switches.items():
+        uplinks = switch.config.get('uplinks', [])
+        if isinstance(uplinks, str):
+            uplinks = [uplinks]
+        for uplink in uplinks:
+            try:
+                local, remote = uplink.split('=')
+                remote_name, remote_port = remote.rsplit(':', 1)
+                links.append(Link((name, int(local)), (remote_name.strip(), int(remote_port)), 'config'))
+            except ValueError:
+                log("%s: ignoring invalid uplink: %s (should be port=switch:port)" % (name, uplink))
+    return links
+
+
+def lldp_links(switches, neighbors):
+    """
+    Returns the links between the given switches (mapping name to
+    loaded switch) according to their LLDP neighbors (mapping name to
+    the result of get_lldp_neighbors()). Neighbors are matched on MAC
+    address or hostname, their ports on name, ifIndex or number.
+    """
+    by_identity = {}
+    for name, switch in switches.items():
+        # Not all backends know these
+        if getattr(switch, 'mac_address', None):
+            by_identity[MacTable.normalize(switch.mac_address)] = name
+        if getattr(switch, 'hostname', None):
+            by_identity[switch.hostname] = name
+
+    links = []
+    for name, found in neighbors.items():
+        for port_num, chassis_id, system_name, port_id in found:
+            remote = by_identity.get(MacTable.normalize(chassis_id)) or by_identity.get(system_name)
+            if remote is None:
+                continue
+            for port in switches[remote].ports:
+                if port_id in (port.name, str(getattr(port, 'if_index', None)), str(port.num)):
+                    links.append(Link((name, port_num), (remote, port.num), 'lldp'))
+                    break
+            else:
+                log("%s port %s: cannot find LLDP neighbor port %s on %s" % (name, port_num, port_id, remote))
+    return links
+
+
+def port_vlans(switch, port_num):
+    """
+    Returns the sets of tagged and untagged vlan ids of a port.
+    """
+    port = next(p for p in switch.ports if p.num == port_num)
+    tagged = {v.dotq_id for v in switch.vlans if v.ports[port] == Vlan.TAGGED}
+    untagged = {v.dotq_id for v in switch.vlans if v.ports[port] == Vlan.UNTAGGED}
+    return tagged, untagged
+
+
+def compare(link, switches):
+    """
+    Returns a list of problems with the vlan configuration of the given
+    link (empty when both ends match).
+    """
+    (a_name, a_port), (b_name, b_port) = link.a, link.b
+    try:
+        a_tagged, a_untagged = port_vlans(switches[a_name], a_port)
+        b_tagged, b_untagged = port_vlans(switches[b_name], b_port)
+    except StopIteration:
+        return ["port does not exist"]
+
+    def ids(vlans):
+        return ', '.join(str(v) for v in sorted(vlans))
+
+    problems = []
+    if a_tagged - b_tagged:
+        problems.append("tagged on %s only: %s" % (a_name, ids(a_tagged - b_tagged)))
+    if b_tagged - a_tagged:
+        problems.append("tagged on %s only: %s" % (b_name, ids(b_tagged - a_tagged)))
+    if a_untagged != b_untagged:
+        problems.append("untagged vlan differs: %s on %s, %s on %s" % (
+            ids(a_untagged) or "none", a_name, ids(b_untagged) or "none", b_name))
+    return problems
+
+
+def load(constructors, loaded=None, concurrency=8):
+    """
+    Load the given switches (constructors mapping switch name to
+    constructor) and their LLDP neighbors in parallel. Switches that are
+    already loaded can be passed in loaded (mapping name to switch).
+    Returns a (switches, neighbors, report lines, switches created)
+    tuple, the first two mapping name to the switch and its neighbors
+    for all switches that could be loaded. The created switches are
+    already logged out again.
+    """
+    loader = SwitchLoader(constructors, loaded, concurrency)
+    switches = {}
+    neighbors = {}
+    lines = []
+    try:
+        # Start loading everything first, so all switches are loaded
+        # in parallel
+        pending = {loader.load(name) for name in constructors}
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=0.1)
+            # Show progress logged by the workers
+            flush_deferred()
+
+        for name in constructors:
+            try:
+                switches[name], neighbors[name] = loader.load(name).result()
+            except Exception as e:
+                lines.append("%s: loading failed: %s" % (name, e))
+    finally:
+        created = loader.close()
+    return switches, neighbors, lines, created
+
+
+def report(switches, neighbors):
+    """
+    Returns the report lines for all uplinks between the given switches,
+    as returned by load().
+    """
+    lines = []
+    links = {}
+    for link in configured_links(switches) + lldp_links(switches, neighbors):
+        # The same link is usually found from both ends, and from the
+        # config as well as LLDP
+        links.setdefault(link.key, link)
+
+    for link in links.values():
+        if link.a[0] not in switches or link.b[0] not in switches:
+            lines.append("%s: cannot check, switch not loaded" % link)
+            continue
+        problems = compare(link, switches)
+        lines.append("%s: %s" % (link, '; '.join(problems) if problems else "OK"))
+
+    if not links:
+        lines.append("No uplinks found (configure them with the uplinks option, or enable LLDP)")
+    return lines
+
+
+def check(constructors, loaded=None, concurrency=8):
+    """
+    Check all uplinks between the given switches, see load(). Returns a
+    (report lines, switches created) tuple, the latter are already
+    logged out again.
+    """
+    switches, neighbors, lines, created = load(constructors, loaded, concurrency)
+    return lines + report(switches, neighbors), created
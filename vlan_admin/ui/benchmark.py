@@ -0,0 +1,83 @@
+"""
+Measures how long it takes to draw the VLAN/port matrix while scrolling
+through it, using a synthetic switch (no actual switch or terminal is
+needed):
+
+    python -m vlan_admin.ui.benchmark --ports 52 --vlans 500
+"""
+
+import argparse
+import random
+import statistics
+import time
+
+import urwid
+
+from ..backends.common import Port, Switch, Vlan
+from .widgets import PortVlanMatrix, TopLine
+
+
+class BenchmarkSwitch(Switch):
+    """
+    Switch with the given number of ports and vlans, with random
+    memberships, that is never actually contacted.
+    """
+    switch_attrs = []
+
+    def __init__(self, num_ports, num_vlans):
+        super().__init__({})
+        for num in range(1, num_ports + 1):
+            self.ports.append(Port(self, num, '', 1, link_status='Up'))
+        for dotq_id in range(1, num_vlans + 1):
+            vlan = Vlan(self, dotq_id, dotq_id, 'vlan %d' % dotq_id)
+            for port in self.ports:
+                vlan.ports[port] = random.choice([Vlan.NOTMEMBER, Vlan.TAGGED])
+            self.vlans.append(vlan)
+            self.dotq_vlans[dotq_id] = vlan
+
+    def __str__(self):
+        return "benchmark"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the time to draw the matrix while scrolling through it")
+    parser.add_argument('--ports', type=int, default=52)
+    parser.add_argument('--vlans', type=int, default=500)
+    parser.add_argument('--columns', type=int, default=250, help="Terminal width")
+    parser.add_argument('--rows', type=int, default=60, help="Terminal height")
+    args = parser.parse_args()
+
+    random.seed(0)
+    switch = BenchmarkSwitch(args.ports, args.vlans)
+    matrix = PortVlanMatrix(None, switch, lambda widget, size, key: key)
+    # Like the interface, but without the other panels
+    top = urwid.Pile([
+        ('pack', urwid.Padding(TopLine(matrix, 'VLAN / Port mappings'), align='center')),
+        ('weight', 1, urwid.SolidFill(' ')),
+    ])
+    size = (args.columns, args.rows)
+
+    # urwid only caches the canvases of widgets that are part of a
+    # canvas that is still in use, so keep the last one like the
+    # screen does
+    canvas = top.render(size, focus=True)
+
+    def frame(key):
+        nonlocal canvas
+        start = time.perf_counter()
+        top.keypress(size, key)
+        canvas = top.render(size, focus=True)
+        return time.perf_counter() - start
+
+    # Scroll down through all vlans, then to the right through all
+    # ports
+    times = [frame('down') for i in range(args.vlans - 1)]
+    times += [frame('right') for i in range(args.ports - 1)]
+
+    print("%d frames of %dx%d, %d ports, %d vlans" % (len(times), args.columns, args.rows, args.ports, args.vlans))
+    print("frame time: mean %.2fms, median %.2fms, max %.2fms" % (
+        statistics.mean(times) * 1000, statistics.median(times) * 1000, max(times) * 1000))
+
+
+if __name__ == '__main__':
+    main()
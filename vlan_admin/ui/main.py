@@ -1,9 +1,19 @@
+import collections
+import concurrent.futures
+import csv
+import json
+import re
+import time
 import urwid
 
-from .widgets import DisableEdit, KeypressAdapter, PortVlanMatrix, TopLine
+from .poller import BackgroundTask, CounterSampler, LinkStatusPoller
+from .prefetch import SwitchPrefetcher
+from .widgets import ChangeList, DisableEdit, KeypressAdapter, PortVlanMatrix, TopLine
 
-from ..backends.common import CommitException
-from ..log import log
+from .. import journal, profiling, snapshot, trunks
+from ..backends.common import CommitException, MacTable
+from ..counters import COUNTERS
+from ..log import flush_deferred, log
 
 # Support vim key bindings in the default widgets
 urwid.command_map['j'] = 'cursor down'
@@ -20,6 +30,7 @@ class Interface(object):
     help_text = 'light gray'
     normal_bg = 'black'
     focus_bg = 'light gray'
+    selected_bg = 'dark gray'
     help_bg = 'dark blue'
     palette = [
         ('header', 'black', 'light gray'),
@@ -30,44 +41,382 @@ class Interface(object):
         ('none_focus', normal_text, focus_bg),
         ('tagged_focus', tagged_text, focus_bg),
         ('untagged_focus', untagged_text, focus_bg),
+        ('none_selected', normal_text, selected_bg),
+        ('tagged_selected', tagged_text, selected_bg),
+        ('untagged_selected', untagged_text, selected_bg),
         ('overlay', 'white', 'dark blue'),
         ('active_port', normal_text + ',bold', normal_bg),
         ('help_bar', help_text, help_bg),
     ]
 
-    def __init__(self, switch_consructors):
+    # Redraw the screen for new log messages at most once per this many
+    # seconds. Any messages logged in between are shown by the next
+    # redraw (at the latest when the mainloop becomes idle again).
+    log_redraw_interval = 0.1
+
+    # Maximum height of the list of unsaved changes, longer lists can
+    # be scrolled
+    changelist_rows = 10
+
+    # Number of switches to retrieve the MAC table of at the same time
+    mac_lookup_concurrency = 4
+
+    # Attributes that hold the state of the current switch, which are
+    # saved when switching to another switch (see suspend_switch)
+    session_attrs = [
+        'constructor', 'switch', 'main_widget', 'matrix', 'changelist',
+        'port_widgets', 'vlan_widgets', 'switch_widgets',
+    ]
+
+    def __init__(self, switch_consructors, log_lines=1000, stats_file=None, trap_address=None, keep_switches=4,
+                 prefetch=None, counters_file=None):
+        self.constructor = None
         self.switch = None
+        self.poller = None
+        self.sampler = None
+        # Switches that are loaded, but not currently shown, least
+        # recently used first. Maps constructor to a dict with the
+        # session_attrs.
+        self.sessions = collections.OrderedDict()
+        # Maps loaded switches to the result of Switch.probe() right
+        # after they were loaded (or committed to), see take_baseline()
+        self.probes = {}
+        # BackgroundTasks in progress
+        self.tasks = set()
+        self.keep_switches = keep_switches
+        # Number of switches to load at the same time in the background
+        # at startup, or None to not load switches before they are
+        # selected
+        self.prefetch = prefetch
+        self.prefetcher = None
+        # Switch selected while it was still being prefetched
+        self.pending_constructor = None
+        # Buttons in the switch selection popup, by constructor
+        self.switch_buttons = {}
+        self.trap_address = trap_address
         self.switch_constructors = switch_consructors
+        self.log_lines = log_lines
+        self.stats_file = stats_file
+        # Request statistics of all switches used in this session
+        self.session_stats = []
+        self.counters_file = counters_file
+        # Counter samples of all switches closed so far, as CSV rows
+        self.counter_rows = []
+        self._last_log_redraw = 0
         self._overlay_widget = None
         super(Interface, self).__init__()
 
     def start(self):
         # Create this early so we can (invisibly) log while the sitch
         # selection popup is shown and the log is persistent across
-        # switch changes.
-        self.debug = urwid.Text('')
+        # switch changes. This keeps (at most) log_lines lines, each in
+        # its own Text widget, so adding a line does not need to
+        # re-layout all previous lines.
+        self.debug_lines = urwid.SimpleFocusListWalker([])
+        self.debug = urwid.ListBox(self.debug_lines)
         # Start up with a dummy widget so we can decide on the first
         # widget to show *inside* the loop
         self.main_widget = urwid.Filler(urwid.Text(""))
         self.loop = urwid.MainLoop(self.main_widget, palette=Interface.palette, unhandled_input=self.unhandled_input)
 
-        # Register this idle callback before starting the mainloop, so
-        # it gets called before the idle callback inside MainLoop that
-        # redraws the screen.
+        # Register these idle callbacks before starting the mainloop,
+        # so they get called before the idle callback inside MainLoop
+        # that redraws the screen.
+        self.loop.event_loop.enter_idle(self.deliver_signals)
         self.loop.event_loop.enter_idle(self.check_focus)
+
+        if self.trap_address:
+            # Only import this when needed, since it needs pysnmp
+            from ..backends.traps import TrapReceiver
+            receiver = TrapReceiver(self.trap_address, self.handle_notification)
+            self.loop.watch_file(receiver.fileno(), receiver.receive)
+
         self.loop.screen.run_wrapper(self.run)
 
-    def select_switch(self, constructor):
+        if self.stats_file:
+            with open(self.stats_file, 'w') as f:
+                json.dump(self.session_stats, f, indent=2)
+
+        if self.counters_file:
+            with open(self.counters_file, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['switch', 'port', 'time'] + [name for name, bits in COUNTERS])
+                writer.writerows(self.counter_rows)
+
+    def stop_poller(self):
+        if self.poller:
+            self.poller.stop()
+            self.poller = None
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler = None
+
+    def run_in_background(self, fn, callback):
+        """
+        Call fn() in a background thread, and pass the finished Future
+        to callback() in the main loop.
+        """
+        def done(future):
+            self.tasks.discard(task)
+            callback(future)
+        task = BackgroundTask(self.loop, fn, done)
+        self.tasks.add(task)
+
+    def close_switch(self, switch):
+        """
+        Log out of the given switch and save its request statistics.
+        """
+        self.probes.pop(switch, None)
+        switch.do_logout()
+        if switch.journal:
+            switch.journal.close()
+            switch.journal = None
+        self.session_stats.append(dict(switch=str(switch), **switch.stats.as_dict()))
+        if self.counters_file:
+            for port in switch.ports:
+                if port.counters:
+                    self.counter_rows.extend(
+                        [str(switch), port.num, timestamp] + values
+                        for timestamp, values in port.counters.history())
+
+    def close_all_switches(self):
+        self.stop_poller()
+        for task in list(self.tasks):
+            task.stop()
+        self.tasks.clear()
+        if self.prefetcher:
+            # These are already logged out, so just keep their
+            # statistics
+            for switch in self.prefetcher.stop():
+                self.session_stats.append(dict(switch=str(switch), **switch.stats.as_dict()))
+            self.prefetcher = None
         if self.switch:
-            self.switch.do_logout()
+            self.close_switch(self.switch)
+            self.switch = None
+        while self.sessions:
+            constructor, session = self.sessions.popitem(last=False)
+            self.close_switch(session['switch'])
 
-        self.switch = constructor()
+    def suspend_switch(self):
+        """
+        Stop using the current switch, but keep it loaded (including
+        its widgets and unsaved changes), so switching back to it is
+        instant. When more than keep_switches switches are loaded, the
+        least recently used one is closed.
+        """
+        self.stop_poller()
+        session = {attr: getattr(self, attr) for attr in self.session_attrs}
+        # Also log out when keeping the switch, since the FS726T only
+        # allows a single login at a time. It logs in again
+        # automatically when needed.
+        self.switch.do_logout()
+        self.switch = None
+
+        self.sessions[session['constructor']] = session
+        # Never close switches with unsaved changes, even when that
+        # means keeping more than keep_switches
+        excess = len(self.sessions) - max(self.keep_switches, 0)
+        for constructor, evicted in list(self.sessions.items()):
+            if excess <= 0:
+                break
+            if not evicted['switch'].changes:
+                log("Closing %s, which was not used recently" % evicted['switch'])
+                del self.sessions[constructor]
+                self.close_switch(evicted['switch'])
+                excess -= 1
+
+    def take_baseline(self, switch):
+        """
+        Remember the result of Switch.probe() for the given (just
+        loaded or committed to) switch, retrieved in the background, to
+        check for changes made by others when it is resumed.
+        """
+        self.probes.pop(switch, None)
+
+        def done(future):
+            try:
+                value = future.result()
+            except Exception as e:
+                log("Failed to probe %s: %s" % (switch, e))
+                return
+            # Unless it was closed in the meantime
+            loaded = [self.switch] + [session['switch'] for session in self.sessions.values()]
+            if value is not None and switch in loaded:
+                self.probes[switch] = value
+        self.run_in_background(switch.probe, done)
+
+    def resume_switch(self, session):
+        """
+        Make a switch kept by suspend_switch() the current switch again.
+        This is instant: the switch is checked for changes made by
+        something else in the meantime (according to Switch.probe())
+        in the background, offering to reload it when it was changed.
+        """
+        for attr in self.session_attrs:
+            setattr(self, attr, session[attr])
+        self.overlay_widget = None
+        self.start_poller()
+        # Link status is not updated while suspended, so refresh it now
+        if self.poller:
+            self.poller.poll(self.loop, None)
+
+        switch = self.switch
+        if switch not in self.probes:
+            return
+
+        def done(future):
+            try:
+                changed = future.result() != self.probes.get(switch)
+            except Exception as e:
+                log("Failed to probe %s: %s" % (switch, e))
+                return
+            if not changed or switch is not self.switch:
+                return
+            if switch.changes:
+                log("%s was changed since it was loaded, keeping it to not lose unsaved changes" % switch)
+                return
+            self.yesno_popup(
+                "%s was changed by something else since it was loaded.\nReload it?" % switch,
+                lambda: self.select_switch(self.constructor))
+        self.run_in_background(switch.probe, done)
+
+    def select_switch(self, constructor):
+        self.pending_constructor = None
+        # Take out the session first, so suspend_switch() cannot close it
+        session = self.sessions.pop(constructor, None)
+
+        if self.switch and constructor is self.constructor:
+            # Selecting the current switch reloads it
+            self.stop_poller()
+            self.close_switch(self.switch)
+            self.switch = None
+        elif self.switch:
+            self.suspend_switch()
+
+        if session:
+            self.resume_switch(session)
+            return
+
+        switch = None
+        if self.prefetcher:
+            load = self.prefetcher.state(constructor)
+            if load and not load.done:
+                self.pending_constructor = constructor
+                self.status_changed(None, "Waiting for %s to finish loading..." % load.name)
+                return
+            switch = self.prefetcher.take(constructor)
+
+        self.constructor = constructor
+        self.switch = switch or constructor()
+        self.switch.coalesce_signals = True
         self.create_widgets()
         self.overlay_widget = None
         urwid.connect_signal(self.switch, 'status_changed', self.status_changed)
 
-        # Get switch status
-        self.switch.get_status()
+        # Get switch status, unless it was already loaded in the
+        # background
+        if switch is None:
+            with profiling.phase('get_status'):
+                self.switch.get_status()
+
+        self.start_poller()
+        self.open_journal()
+        self.take_baseline(self.switch)
+
+    def open_journal(self):
+        """
+        Start journaling the changes to the current (just loaded)
+        switch. When a journal of a previous session exists, offer to
+        replay it first.
+        """
+        switch = self.switch
+        name = switch.config.name
+
+        def start():
+            try:
+                switch.journal = journal.Journal(switch, name)
+            except OSError as e:
+                log("Cannot write journal for %s: %s" % (switch, e))
+
+        records = journal.load(name)
+        if not records:
+            start()
+            return
+
+        def replay():
+            skipped = journal.replay(switch, records)
+            if skipped:
+                log("Skipped %d conflicting changes from the journal" % skipped)
+            start()
+
+        text = "Found %d unsaved changes to %s from a previous session." % (len(records), switch)
+        conflicts = journal.conflicts(switch, records)
+        if conflicts:
+            text += "\nThe switch was changed since then, so some might be skipped (%s%s)." % (
+                ', '.join(conflicts[:2]), ', ...' if len(conflicts) > 2 else '')
+        # Declining starts a new journal, discarding the old one
+        self.yesno_popup(text + "\nQueue these as unsaved changes again?", replay, start)
+
+    def switch_loaded(self, constructor, load):
+        """
+        Called by the prefetcher when a switch finished loading.
+        """
+        if constructor in self.switch_buttons:
+            self.switch_buttons[constructor].set_label(self.switch_label(load.name, constructor))
+        if constructor is self.pending_constructor:
+            self.pending_constructor = None
+            self.select_switch(constructor)
+
+    def start_poller(self):
+        """
+        Start polling the link status and sampling the traffic
+        counters of the current switch, if it supports that. The
+        intervals (and random jitter added to them) in seconds can be
+        configured per switch, an interval of 0 disables polling.
+        """
+        interval = float(self.switch.config.get('link_poll_interval', 10))
+        jitter = float(self.switch.config.get('link_poll_jitter', 1))
+        notification_interval = float(self.switch.config.get('link_poll_interval_with_traps', 300))
+        if self.switch.supports_link_polling and interval > 0:
+            self.poller = LinkStatusPoller(self.loop, self.switch, interval, jitter, notification_interval)
+            self.poller.start()
+
+        interval = float(self.switch.config.get('counter_interval', 30))
+        if self.switch.supports_counters and interval > 0:
+            self.sampler = CounterSampler(self.loop, self.switch, interval, jitter)
+            # Take the first sample right away, rates need two
+            self.sampler.poll(self.loop, None)
+
+    def handle_notification(self, notification):
+        """
+        Called for each SNMP notification received (when --trap-listen
+        is used).
+        """
+        if self.switch and self.switch.handle_notification(notification):
+            log("Received %s" % notification)
+            if self.poller:
+                self.poller.notification_received(refresh=(notification.oper_status == 'up'))
+            return
+
+        # Also keep switches that are loaded but not shown up-to-date
+        for session in self.sessions.values():
+            if session['switch'].handle_notification(notification):
+                log("Received %s" % notification)
+                return
+
+        log("Ignoring %s" % notification)
+
+    def deliver_signals(self):
+        """
+        Deliver the signals of the current switch that were coalesced
+        since the previous main loop iteration, so each widget is
+        updated once for a burst of changes.
+        """
+        if self.switch:
+            self.switch.deliver_deferred_signals()
+            # Everything changed since the previous iteration (e.g. by
+            # a single keypress) is undone at once
+            self.switch.history.end_action()
 
     def check_focus(self):
         """
@@ -87,13 +436,42 @@ class Interface(object):
         def select_switch(button, constructor):
             self.select_switch(constructor)
 
+        self.switch_buttons = {}
         for name, constructor in self.switch_constructors.items():
-            button = urwid.Button(name)
+            button = urwid.Button(self.switch_label(name, constructor))
             urwid.connect_signal(button, "click", select_switch, constructor)
             body.append(urwid.AttrMap(button, None, focus_map="reversed"))
+            self.switch_buttons[constructor] = button
 
         self.overlay_widget = urwid.ListBox(urwid.SimpleFocusListWalker(body))
 
+    def loaded_switch(self, constructor):
+        """
+        Returns the switch for the given constructor if it is the
+        current switch or kept loaded, or None otherwise.
+        """
+        if constructor is self.constructor and self.switch:
+            return self.switch
+        elif constructor in self.sessions:
+            return self.sessions[constructor]['switch']
+        return None
+
+    def switch_label(self, name, constructor):
+        """
+        Returns the label for a switch in the switch selection popup,
+        showing whether it is loaded.
+        """
+        switch = self.loaded_switch(constructor)
+        load = self.prefetcher.state(constructor) if self.prefetcher else None
+        if switch is None and load:
+            return "%s (%s)" % (name, load)
+        elif switch is None:
+            return name
+        elif switch.changes:
+            return "%s (loaded, %d unsaved changes)" % (name, len(switch.changes))
+        else:
+            return "%s (loaded)" % name
+
     def create_widgets(self):
         self.port_widgets = {}
         self.vlan_widgets = {}
@@ -123,7 +501,7 @@ class Interface(object):
 
         dbg = TopLine(self.debug, 'Debug')
 
-        self.changelist = urwid.Text('')
+        self.changelist = ChangeList(self.changelist_rows)
         changelist = TopLine(self.changelist, 'Unsaved changes')
         urwid.connect_signal(self.switch, 'changelist_changed', self.fill_changelist)
         self.fill_changelist(self.switch)
@@ -135,23 +513,34 @@ class Interface(object):
                 return key
             return None
 
-        self.matrix = PortVlanMatrix(self, self.switch, vlan_keypress_handler)
+        with profiling.phase('matrix'):
+            self.matrix = PortVlanMatrix(self, self.switch, vlan_keypress_handler)
         matrix = urwid.Padding(TopLine(self.matrix, 'VLAN / Port mappings'), align='center')
 
         help_bar = urwid.AttrMap(urwid.Padding(urwid.Columns([
             ('pack', urwid.LineBox(urwid.Text(t))) for t in [
                 "Tab: next panel",
                 "←↓↑→/hjkl: navigate",
+                "v: select range",
                 "F11/c: commit unsaved",
+                "F8/p: preview commit",
+                "F2/z: undo",
+                "F3/y: redo",
                 "Ins/i: create VLAN",
                 "Del/d: delete VLAN",
                 "F12/o: other switch",
+                "F9/s: statistics",
+                "F7/m: find MAC",
+                "F4/a: check uplinks",
+                "F5/w: save snapshot",
+                "F6/r: restore snapshot",
                 "F10/q: quit",
             ]
         ], dividechars=1), align='center', width='clip'), 'help_bar')
 
         def update_matrix(switch):
-            self.matrix.create_widgets()
+            with profiling.phase('matrix'):
+                self.matrix.create_widgets()
             # Focus the matrix
             self.main_widget.base_widget.set_focus(matrix)
 
@@ -175,6 +564,8 @@ class Interface(object):
                     bottom.base_widget.set_focus(port_details)
                 elif bottom.base_widget.get_focus() is port_details:
                     bottom.base_widget.set_focus(vlan_details)
+                elif pile.get_focus() is bottom and changelist.selectable():
+                    pile.set_focus(changelist)
                 else:
                     pile.set_focus(matrix)
             else:
@@ -215,6 +606,9 @@ class Interface(object):
         if len(self.switch_constructors) == 1:
             self.select_switch(next(iter(self.switch_constructors.values())))
         else:
+            if self.prefetch:
+                self.prefetcher = SwitchPrefetcher(
+                    self.loop, self.switch_constructors, self.prefetch, self.switch_loaded)
             self.select_switch_popup()
 
         log("Starting mainloop")
@@ -314,19 +708,18 @@ class Interface(object):
                 widget_dict['active_object_handler'] = update_details
 
     def fill_changelist(self, switch):
-        if switch.changes:
-            text = '\n'.join([str(c) for c in switch.changes])
-        else:
-            text = 'No changes'
-        self.changelist.set_text(text)
+        self.changelist.set_changes(switch.changes)
 
     def unhandled_input(self, key):
         if key == 'q' or key == 'Q' or key == 'f10':
-            self.switch.do_logout()
+            self.close_all_switches()
             raise urwid.ExitMainLoop()
         elif key in ['f11', 'c', 'C']:
             try:
-                self.switch.commit_all()
+                with profiling.phase('commit_all'):
+                    self.switch.commit_all()
+                # The switch configuration changed, on purpose
+                self.take_baseline(self.switch)
             except CommitException as e:
                 self.show_popup(str(e))
         elif key in ['f12', 'o', 'O']:
@@ -334,6 +727,28 @@ class Interface(object):
         elif key in ['insert', 'i', 'I']:
             if self.switch:
                 self.add_vlan_popup()
+        elif key in ['f8', 'p', 'P']:
+            if self.switch:
+                self.plan_popup()
+        elif key in ['f9', 's', 'S']:
+            if self.switch:
+                self.stats_popup()
+        elif key in ['f5', 'w', 'W']:
+            if self.switch:
+                self.save_snapshot_popup()
+        elif key in ['f6', 'r', 'R']:
+            if self.switch:
+                self.input_popup("Snapshot file to compare with?", self.restore_snapshot)
+        elif key in ['f2', 'z', 'Z']:
+            if self.switch and not self.switch.undo():
+                log("Nothing to undo")
+        elif key in ['f3', 'y', 'Y']:
+            if self.switch and not self.switch.redo():
+                log("Nothing to redo")
+        elif key in ['f4', 'a', 'A']:
+            self.check_uplinks()
+        elif key in ['f7', 'm', 'M']:
+            self.input_popup("MAC address (or first part of it) to look up on all switches?", self.lookup_macs)
         else:
             log("Unhandled keypress: %s" % str(key))
 
@@ -385,6 +800,189 @@ class Interface(object):
         widget = KeypressAdapter(widget, hide_on_keypress)
         self.overlay_widget = urwid.Filler(widget)
 
+    def scroll_popup(self, lines):
+        """
+        Show a popup with the given lines of text, which can be scrolled
+        through with the arrow keys.
+        """
+        def handle_keypress(widget, size, key):
+            if key in ['enter', 'esc', 'f10', 'q', 'Q']:
+                self.overlay_widget = None
+            else:
+                return key
+            return None
+
+        body = urwid.ListBox(urwid.SimpleFocusListWalker([urwid.Text(l) for l in lines]))
+        body = KeypressAdapter(body, handle_keypress)
+        help = urwid.Text("Use arrows to scroll, enter or f10 to close")
+        self.overlay_widget = urwid.Frame(body, footer=help)
+
+    def plan_popup(self):
+        if not self.switch.changes:
+            self.show_popup("No changes to commit")
+            return
+        lines = ["Committing would do the following:", ""]
+        self.scroll_popup(lines + self.switch.plan_commit().summary())
+
+    def stats_popup(self):
+        lines = ["Request statistics for %s" % self.switch, ""]
+        self.scroll_popup(lines + self.switch.stats.summary())
+
+    def save_snapshot_popup(self):
+        def save(filename):
+            try:
+                snapshot.save(snapshot.snapshot(self.switch), filename)
+            except OSError as e:
+                self.show_popup("Failed to save snapshot: %s" % e)
+                return
+            log("Saved snapshot of %s to %s" % (self.switch, filename))
+
+        default = "%s-%s.json" % (self.switch.config.name, time.strftime('%Y%m%d-%H%M%S'))
+        self.input_popup("Save snapshot (including unsaved changes) to file?", save, default=default)
+
+    def restore_snapshot(self, filename):
+        """
+        Compare the current switch with the given snapshot file, and
+        offer to queue the differences as unsaved changes.
+        """
+        try:
+            changes = snapshot.diff(snapshot.snapshot(self.switch), snapshot.load(filename), self.switch)
+        except (OSError, ValueError, KeyError) as e:
+            self.show_popup("Failed to load snapshot: %s" % e)
+            return
+
+        if not changes:
+            self.show_popup("The switch matches the snapshot")
+            return
+
+        # Only show the first few, all changes can be reviewed in the
+        # unsaved changes list once queued
+        lines = [str(c) for c in changes[:3]]
+        if len(changes) > 3:
+            lines.append("... and %d more" % (len(changes) - 3))
+        self.yesno_popup(
+            "To match the snapshot, the switch needs %d changes:\n%s\nQueue these as unsaved changes?" % (
+                len(changes), '\n'.join(lines)),
+            lambda: self.switch.apply_changes(changes))
+
+    def check_uplinks(self):
+        """
+        Check the vlans on both ends of all uplinks between the
+        configured switches, loading the switches that are not loaded
+        yet in the background, and show the result in a popup when
+        done. For loaded switches, any unsaved changes are included in
+        the check.
+        """
+        loaded = {}
+        for name, constructor in self.switch_constructors.items():
+            switch = self.loaded_switch(constructor)
+            load = self.prefetcher.state(constructor) if self.prefetcher else None
+            if switch is None and load and load.switch:
+                switch = load.switch
+            if switch is not None:
+                loaded[name] = switch
+
+        self.status_changed(None, "Checking uplinks of %d switches..." % len(self.switch_constructors))
+
+        def done(future):
+            # Show progress logged by the workers
+            flush_deferred()
+            try:
+                switches, neighbors, lines, created = future.result()
+            except Exception as e:
+                self.show_popup("Checking uplinks failed: %s" % e)
+                return
+            for switch in created:
+                self.session_stats.append(dict(switch=str(switch), **switch.stats.as_dict()))
+            # Compare in the main loop, since loaded switches might be
+            # changed in the meantime
+            self.scroll_popup(["Uplink check", ""] + lines + trunks.report(switches, neighbors))
+        self.run_in_background(lambda: trunks.load(self.switch_constructors, loaded), done)
+
+    def lookup_macs(self, prefix):
+        """
+        Look up MAC addresses starting with the given prefix in the
+        forwarding databases of all configured switches, retrieving
+        them in parallel in the background, and show the result in a
+        popup when done. For loaded switches, this also updates the MAC
+        counts of their ports.
+        """
+        prefix = MacTable.normalize(prefix)
+        if not re.fullmatch('[0-9a-f]{0,12}', prefix):
+            self.show_popup("Invalid MAC address: '%s'" % prefix)
+            return
+
+        switches = {}
+        temporary = []
+        for name, constructor in self.switch_constructors.items():
+            switch = self.loaded_switch(constructor)
+            load = self.prefetcher.state(constructor) if self.prefetcher else None
+            if switch is None and load and load.switch:
+                switch = load.switch
+            if switch is None:
+                try:
+                    switch = constructor()
+                except Exception as e:
+                    log("Failed to create %s: %s" % (name, e))
+                    continue
+                if switch.supports_mac_table:
+                    temporary.append(switch)
+            if switch.supports_mac_table:
+                switches[name] = switch
+
+        if not switches:
+            self.show_popup("None of the switches supports retrieving MAC tables")
+            return
+
+        self.status_changed(None, "Retrieving MAC tables of %d switches..." % len(switches))
+
+        def retrieve():
+            # Returns when all are done
+            with concurrent.futures.ThreadPoolExecutor(self.mac_lookup_concurrency) as executor:
+                return {name: executor.submit(switch.get_mac_table) for name, switch in switches.items()}
+
+        def done(future):
+            # Show progress logged by the workers
+            flush_deferred()
+            self.show_mac_lookup(prefix, switches, temporary, future.result())
+        self.run_in_background(retrieve, done)
+
+    def show_mac_lookup(self, prefix, switches, temporary, futures):
+        """
+        Show the result of lookup_macs() in a popup, given the switches
+        and the Futures for their MAC tables (both mapping name to
+        these).
+        """
+        found = []
+        errors = []
+        for name, future in futures.items():
+            switch = switches[name]
+            try:
+                table = future.result()
+            except Exception as e:
+                errors.append("%s: retrieving MAC table failed: %s" % (name, e))
+                continue
+
+            if switch not in temporary:
+                switch.update_mac_table(table)
+            ports = {port.num: port for port in switch.ports}
+            for mac, vlan_id, port_num in table.search(prefix):
+                port = ports.get(port_num)
+                where = "port %s" % port_num
+                if port is not None and port.description:
+                    where += " (%s)" % port.description
+                found.append((mac, "" if vlan_id is None else vlan_id, name, where))
+
+        for switch in temporary:
+            self.close_switch(switch)
+
+        lines = ["%d entries for %s on %d switches" % (
+            len(found), MacTable.format(prefix) or "all MAC addresses", len(switches)), ""]
+        lines += errors
+        lines += ["%s  vlan %-4s  %s %s" % (MacTable.format(mac), vlan, name, where)
+                  for mac, vlan, name, where in sorted(found, key=str)]
+        self.scroll_popup(lines)
+
     def yesno_popup(self, text, yes_callback, no_callback=None):
         """
         Show a popup that allows to confirm/decline using y/n.
@@ -408,12 +1006,13 @@ class Interface(object):
         body = urwid.Filler(text, valign='top')
         self.overlay_widget = urwid.Frame(body, footer=help)
 
-    def input_popup(self, text, callback, cancel=None):
+    def input_popup(self, text, callback, cancel=None, default=''):
         """
-        Show a popup that allows to enter text. When enter is pressed,
-        the given callback is called with the entered text. When f10 is
-        pressed, the prompt is canceled and the (optional) cancel
-        function is called with the text entered so far.
+        Show a popup that allows to enter text, starting out with
+        default. When enter is pressed, the given callback is called
+        with the entered text. When f10 is pressed, the prompt is
+        canceled and the (optional) cancel function is called with the
+        text entered so far.
         """
         def handle_keypress(widget, size, key):
             if key == 'enter':
@@ -428,7 +1027,7 @@ class Interface(object):
             return None
 
         text = urwid.Text(text)
-        edit = urwid.Edit()
+        edit = urwid.Edit(edit_text=default)
         edit = KeypressAdapter(edit, handle_keypress)
         help = urwid.Text("Press enter to confirm, f10 or ^G to cancel")
 
@@ -447,8 +1046,17 @@ class Interface(object):
                              lambda: self.switch.delete_vlan(vlan))
 
     def log(self, text):
-        # Note: This discards any existing markup
-        self.debug.set_text(self.debug.text + text + "\n")
+        self.debug_lines.append(urwid.Text(text))
+        excess = len(self.debug_lines) - self.log_lines
+        if excess > 0:
+            del self.debug_lines[:excess]
+        # Keep the newest line in view
+        self.debug_lines.set_focus(len(self.debug_lines) - 1)
+
         # Force a screen redraw (in case we're called from a keypress
-        # handler which takes a while to copmlete, for example).
-        self.loop.draw_screen()
+        # handler which takes a while to copmlete, for example), but
+        # limit the rate to not slow down verbose logging.
+        now = time.monotonic()
+        if now - self._last_log_redraw >= self.log_redraw_interval:
+            self._last_log_redraw = now
+            self.loop.draw_screen()
@@ -0,0 +1,164 @@
+import concurrent.futures
+import os
+import random
+import threading
+
+from ..log import log
+
+
+class Poller(object):
+    """
+    Periodically calls fetch() in a background thread, and passes the
+    result to apply() in the main loop. Subclasses must implement both.
+    """
+
+    def __init__(self, loop, switch, interval, jitter):
+        self.loop = loop
+        self.switch = switch
+        self.interval = interval
+        self.jitter = jitter
+        self.alarm = None
+        self.future = None
+        self.stopped = False
+        # Makes sure the worker thread does not write to the pipe after
+        # it was closed (and its fd possibly reused)
+        self.lock = threading.Lock()
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        # The worker thread writes to this pipe to wake up the main loop
+        self.pipe = self.loop.watch_pipe(self.poll_done)
+
+    def start(self):
+        delay = max(0, self.interval + random.uniform(-self.jitter, self.jitter))
+        self.alarm = self.loop.set_alarm_in(delay, self.poll)
+
+    def stop(self):
+        if self.alarm:
+            self.loop.remove_alarm(self.alarm)
+        self.executor.shutdown(wait=False)
+        with self.lock:
+            self.stopped = True
+            self.loop.remove_watch_pipe(self.pipe)
+            os.close(self.pipe)
+
+    def fetch(self):
+        raise NotImplementedError()
+
+    def apply(self, result):
+        raise NotImplementedError()
+
+    def poll(self, loop, user_data):
+        self.alarm = None
+        self.future = self.executor.submit(self.fetch)
+        self.future.add_done_callback(self.wake_up)
+
+    def wake_up(self, future):
+        # Called in the worker thread
+        with self.lock:
+            if not self.stopped:
+                os.write(self.pipe, b'x')
+
+    def poll_done(self, data):
+        if self.stopped:
+            return False
+
+        try:
+            self.apply(self.future.result())
+        except Exception as e:
+            log("%s failed: %s" % (self.description, e))
+
+        self.start()
+        # Keep watching the pipe
+        return True
+
+
+class LinkStatusPoller(Poller):
+    """
+    Periodically retrieves the link status of all ports of a switch in
+    a background thread, and applies the result to the switch model in
+    the main loop (which emits details_changed for changed ports only).
+    """
+    description = "Polling link status"
+
+    def __init__(self, loop, switch, interval, jitter, notification_interval=None):
+        super().__init__(loop, switch, interval, jitter)
+        # Interval to use once the switch has been seen to send link
+        # notifications, so polling is just a fallback for missed ones
+        self.notification_interval = notification_interval or interval
+
+    def notification_received(self, refresh=False):
+        """
+        Called when the switch sent a link notification. This switches
+        to the (slower) notification interval. When refresh is True,
+        poll right away (e.g. to learn the speed of a link that just
+        came up).
+        """
+        self.interval = self.notification_interval
+        if refresh and self.alarm:
+            self.loop.remove_alarm(self.alarm)
+            self.poll(self.loop, None)
+
+    def fetch(self):
+        return self.switch.get_link_status()
+
+    def apply(self, result):
+        self.switch.update_link_status(result)
+
+
+class CounterSampler(Poller):
+    """
+    Periodically samples the traffic counters of all ports of a switch,
+    see Switch.update_counters().
+    """
+    description = "Sampling counters"
+
+    def fetch(self):
+        return self.switch.get_counters()
+
+    def apply(self, result):
+        self.switch.update_counters(result)
+
+
+class BackgroundTask(object):
+    """
+    Calls fn() once in a background thread, and passes the finished
+    Future to callback() in the main loop. After stop(), callback is
+    not called anymore (but fn keeps running until it is done).
+    """
+
+    def __init__(self, loop, fn, callback):
+        self.loop = loop
+        self.callback = callback
+        self.stopped = False
+        # Makes sure the worker thread does not write to the pipe after
+        # it was closed (and its fd possibly reused)
+        self.lock = threading.Lock()
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(1)
+        # The worker thread writes to this pipe to wake up the main loop
+        self.pipe = self.loop.watch_pipe(self.task_done)
+        self.future = self.executor.submit(fn)
+        self.future.add_done_callback(self.wake_up)
+
+    def stop(self):
+        with self.lock:
+            if self.stopped:
+                return
+            self.stopped = True
+            self.loop.remove_watch_pipe(self.pipe)
+            os.close(self.pipe)
+        self.executor.shutdown(wait=False)
+
+    def wake_up(self, future):
+        # Called in the worker thread
+        with self.lock:
+            if not self.stopped:
+                os.write(self.pipe, b'x')
+
+    def task_done(self, data):
+        if self.stopped:
+            return False
+        self.stop()
+        self.callback(self.future)
+        # The pipe is already removed by stop()
+        return True
@@ -0,0 +1,136 @@
+import concurrent.futures
+import os
+import threading
+import time
+
+from ..log import log
+
+
+class SwitchLoad(object):
+    """
+    The state of loading a single switch in the background.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.future = None
+        self.switch = None
+        self.error = None
+        self.duration = None
+
+    @property
+    def done(self):
+        return self.switch is not None or self.error is not None
+
+    def __str__(self):
+        if self.error is not None:
+            return "failed: %s" % self.error
+        elif self.switch is not None:
+            return "%d ports, %d vlans, loaded in %.1fs" % (
+                len(self.switch.ports), len(self.switch.vlans), self.duration)
+        else:
+            return "loading..."
+
+
+class SwitchPrefetcher(object):
+    """
+    Loads switches (creates them and retrieves their status) in
+    background threads, at most concurrency at the same time. Loaded
+    switches are then logged out and can be picked up with take().
+
+    callback is called in the main loop with the constructor and
+    SwitchLoad whenever a switch finished loading (or failed to).
+    """
+
+    def __init__(self, loop, constructors, concurrency, callback):
+        self.loop = loop
+        self.callback = callback
+        self.stopped = False
+        # Makes sure the worker threads do not write to the pipe after
+        # it was closed (and its fd possibly reused)
+        self.lock = threading.Lock()
+        # Maps constructor to SwitchLoad
+        self.loads = {}
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+        # The worker threads write to this pipe to wake up the main loop
+        self.pipe = self.loop.watch_pipe(self.load_done)
+
+        for name, constructor in constructors.items():
+            load = SwitchLoad(name)
+            self.loads[constructor] = load
+            load.future = self.executor.submit(self.load, constructor)
+            load.future.add_done_callback(self.wake_up)
+
+    def stop(self):
+        """
+        Stop loading switches. Returns the switches that were loaded
+        but not taken.
+        """
+        # shutdown() only cancels pending work itself since Python 3.9
+        for load in self.loads.values():
+            load.future.cancel()
+        self.executor.shutdown(wait=False)
+        with self.lock:
+            self.stopped = True
+            self.loop.remove_watch_pipe(self.pipe)
+            os.close(self.pipe)
+        return [load.switch for load in self.loads.values() if load.switch is not None]
+
+    def load(self, constructor):
+        # Called in a worker thread
+        start = time.monotonic()
+        switch = constructor()
+        switch.get_status()
+        # The FS726T only allows a single login, so do not stay logged
+        # in until the switch is actually used
+        switch.do_logout()
+        return switch, time.monotonic() - start
+
+    def wake_up(self, future):
+        # Called in the worker thread
+        with self.lock:
+            if not self.stopped:
+                os.write(self.pipe, b'x')
+
+    def load_done(self, data):
+        if self.stopped:
+            return False
+
+        for constructor, load in list(self.loads.items()):
+            if load.done or not load.future.done():
+                continue
+
+            try:
+                load.switch, load.duration = load.future.result()
+            except Exception as e:
+                load.error = e
+                log("Loading %s failed: %s" % (load.name, e))
+            else:
+                # Nothing is connected to the signals of the switch
+                # yet, but deliver them so they are not delivered
+                # later, when they no longer apply.
+                load.switch.deliver_deferred_signals()
+                log("Loaded %s: %s" % (load.name, load))
+            self.callback(constructor, load)
+
+        # Keep watching the pipe
+        return True
+
+    def state(self, constructor):
+        """
+        Returns the SwitchLoad for the given constructor, or None when
+        it was taken (or was never loaded).
+        """
+        return self.loads.get(constructor)
+
+    def take(self, constructor):
+        """
+        Returns the loaded switch for the given constructor, or None
+        when it is not (successfully) loaded. The switch is only
+        returned once, later calls return None.
+        """
+        load = self.loads.get(constructor)
+        if load is None or not load.done:
+            return None
+        del self.loads[constructor]
+        return load.switch
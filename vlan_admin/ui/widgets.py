@@ -1,6 +1,7 @@
 import urwid
 
 from ..backends.common import Vlan
+from ..log import log
 
 
 class DisableEdit(urwid.Edit):
@@ -21,7 +22,20 @@ class PortVlanMatrix(urwid.WidgetWrap):
     """
     Widget that displays a matrix of ports versus vlans and allows to
     edit the vlan memberships.
+
+    Pressing v marks the focused cell as one corner of a range, which
+    extends to the focused cell as focus moves. Setting a membership
+    then applies it to the whole range at once. Escape cancels the
+    range.
     """
+
+    # Keys to set the membership of the selected range
+    range_keys = {
+        't': Vlan.TAGGED, 'T': Vlan.TAGGED,
+        'u': Vlan.UNTAGGED, 'U': Vlan.UNTAGGED,
+        ' ': Vlan.NOTMEMBER, 'backspace': Vlan.NOTMEMBER, 'delete': Vlan.NOTMEMBER,
+    }
+
     def __init__(self, interface, switch, vlan_keypress_handler):
         self.interface = interface
         self.switch = switch
@@ -43,6 +57,13 @@ class PortVlanMatrix(urwid.WidgetWrap):
     focus_port = property(lambda self: self.get_focus_attr('port'))
 
     def create_widgets(self):
+        # (port, vlan) of the first corner of the range being selected
+        self.anchor = None
+        # (ports, vlans) sets of the selected range
+        self.selected = None
+        # Maps (port, vlan) to its PortVlanWidget
+        self.cells = {}
+
         # We build a matrix using a Column of Piles, since that allows
         # synchronized horizontal scrolling (for e.g. 48-port switches).
         # Originally, the structure was transposed, which has the
@@ -58,9 +79,14 @@ class PortVlanMatrix(urwid.WidgetWrap):
 
         header_column = [urwid.Text("")]
 
+        # The vlans as shown, see rows()
+        self.vlan_rows = list(self.switch.vlans)
+
         # Create a header column with vlan names
-        for vlan in self.switch.vlans:
-            widget = urwid.Text("")
+        for vlan in self.vlan_rows:
+            # Clip (rather than wrap) names that are made longer later,
+            # to keep one row per vlan
+            widget = urwid.Text("", wrap='clip')
 
             def update_vlan_header(vlan_header, vlan):
                 vlan_header.set_text("%4s: %s" % (vlan.dotq_id, vlan.name))
@@ -78,46 +104,121 @@ class PortVlanMatrix(urwid.WidgetWrap):
         for port in self.switch.ports:
             column = []
 
-            widget = urwid.Text(" %02d " % port.num)
-            if port.up:
-                widget = urwid.AttrMap(widget, 'active_port', None)
-            column.append(widget)
+            widget = urwid.AttrMap(urwid.Text(" %02d " % port.num), None)
 
-            for vlan in self.switch.vlans:
-                widget = urwid.Text("")
+            def update_port_header(port_header, port):
+                port_header.set_attr_map({None: 'active_port' if port.up else None})
+            update_port_header(widget, port)
+            urwid.connect_signal(port, 'details_changed', update_port_header, weak_args=[widget])
+            column.append(widget)
 
-                widget = PortVlanWidget(self.interface, port, vlan)
+            for vlan in self.vlan_rows:
+                widget = PortVlanWidget(self.interface, self, port, vlan)
+                self.cells[port, vlan] = widget
                 column.append(
                     widget
                 )
-            port_columns.append((4, urwid.Pile(column)))
+            port_columns.append((4, MatrixColumn(column)))
 
         # Use two nested Columns, which causes the inner Columns with
         # just the ports to drop ports on the left when the focus would
         # be out of view, which keeps the vlan header name in view
         self._w = urwid.Columns([
-            (self.vlan_header_width, urwid.Pile(header_column)),
+            (self.vlan_header_width, MatrixColumn(header_column)),
             urwid.Columns(port_columns),
         ])
 
+    def selection(self):
+        """
+        Returns the lists of ports and vlans in the range between the
+        anchor and the focused cell, or None when not selecting a range
+        (or the focus is not on a cell).
+        """
+        port, vlan = self.focus_port, self.focus_vlan
+        if self.anchor is None or port is None or vlan is None:
+            return None
+
+        ports, vlans = self.switch.ports, self.switch.vlans
+        first_port, last_port = sorted([ports.index(self.anchor[0]), ports.index(port)])
+        first_vlan, last_vlan = sorted([vlans.index(self.anchor[1]), vlans.index(vlan)])
+        return ports[first_port:last_port + 1], vlans[first_vlan:last_vlan + 1]
+
+    def is_selected(self, port, vlan):
+        return self.selected is not None and port in self.selected[0] and vlan in self.selected[1]
+
+    def update_selection(self):
+        old = self.selected
+        selection = self.selection()
+        self.selected = None if selection is None else (set(selection[0]), set(selection[1]))
+        # Redraw the cells that were or are now selected
+        for ports, vlans in filter(None, [old, self.selected]):
+            for port in ports:
+                for vlan in vlans:
+                    self.cells[port, vlan]._invalidate()
+
+    def set_range_membership(self, membership):
+        ports, vlans = self.selection()
+        if membership == Vlan.UNTAGGED and len(vlans) > 1:
+            self.interface.show_popup("A port can only be untagged in one vlan, select a single vlan to do that.")
+            return
+
+        skipped = 0
+        with self.switch.batch():
+            for vlan in vlans:
+                for port in ports:
+                    if membership == Vlan.NOTMEMBER and port.pvid == vlan.dotq_id:
+                        # See PortVlanWidget.keypress()
+                        skipped += 1
+                    else:
+                        vlan.set_port_membership(port, membership)
+        if skipped:
+            log("Kept %d memberships that a PVID points to" % skipped)
+
+        self.anchor = None
+        self.update_selection()
+
     def keypress(self, size, key):
+        if key == 'v' and self.focus_port is not None:
+            self.anchor = (self.focus_port, self.focus_vlan)
+            self.update_selection()
+            return None
+        elif self.anchor is not None and key == 'esc':
+            self.anchor = None
+            self.update_selection()
+            return None
+        elif self.anchor is not None and key in self.range_keys and self.selected is not None:
+            self.set_range_membership(self.range_keys[key])
+            return None
+
+        ports, _ = self._w.contents[1]
+        focused_port, focused_vlan = ports.focus_position, ports.focus.focus_position
+
         ret = super(PortVlanMatrix, self).keypress(size, key)
 
-        # Copy the vertical focus position of the focused column to
-        # all other columns, so horizontal navigation keeps the
-        # vertical position
+        # When moving to another column, copy the vertical focus
+        # position of the previous column to it, so horizontal
+        # navigation keeps the vertical position. This is only done
+        # for the newly focused column, since changing the focus
+        # position of a column invalidates (and thus redraws) all of
+        # its cells.
         # It would be nicer to do this in a focus change callback,
         # but it seems MonitoredFocusList does have a callback, but
         # there can be just one callback and it is already used by
         # Columns
         if ret is None:
-            ports, _ = self._w.contents[1]
-            focused_vlan = ports.focus.focus_position
-            for pile, _ in ports.contents:
-                pile.focus_position = focused_vlan
+            if ports.focus_position != focused_port:
+                ports.focus.focus_position = focused_vlan
+
+            if self.anchor is not None:
+                self.update_selection()
 
         return ret
 
+    def rows(self, size, focus=False):
+        # Every vlan and the port header take exactly one row, see
+        # MatrixColumn
+        return len(self.vlan_rows) + 1
+
     # Always mark ourselves as selectable, even if we are still empty at
     # initialization, since Columns and Pile cache their contents
     # selectability once during init only. This might be a bug, but this
@@ -126,6 +227,31 @@ class PortVlanMatrix(urwid.WidgetWrap):
         return True
 
 
+class MatrixColumn(urwid.Pile):
+    """
+    A column of the matrix, where every widget is a flow widget that
+    takes exactly one row. Knowing this saves asking every widget for
+    its sizing and rows (which urwid does multiple times per redraw).
+    """
+    _sizing = frozenset(['flow'])
+
+    def sizing(self):
+        return self._sizing
+
+    def rows(self, size, focus=False):
+        return len(self.contents)
+
+    def get_item_rows(self, size, focus):
+        return [1] * len(self.contents)
+
+    def get_rows_sizes(self, size, focus=False):
+        # Used instead of get_item_rows() by newer urwid versions.
+        # Returns widths, heights and sizes to render each item with.
+        maxcol, = size
+        count = len(self.contents)
+        return (maxcol,) * count, (1,) * count, ((maxcol,),) * count
+
+
 class PortVlanWidget(urwid.Widget):
     """
     Class to display and edit a port / vlan combination.
@@ -133,15 +259,21 @@ class PortVlanWidget(urwid.Widget):
 
     _sizing = frozenset(['flow'])
 
-    def __init__(self, interface, port, vlan):
+    # Canvases shared by all cells, keyed by (attribute, width). The
+    # attribute determines the text, so there are only a few.
+    canvas_cache = {}
+
+    def __init__(self, interface, matrix, port, vlan):
         super(PortVlanWidget, self).__init__()
         self._selectable = True
         self.interface = interface
+        self.matrix = matrix
         self.port = port
         self.vlan = vlan
 
         def memberships_changed(vlan, port, membership):
-            if port is self.port:
+            # port is None when memberships of multiple ports changed
+            if port is None or port is self.port:
                 self._invalidate()
 
         # TODO: This signal handler prevents PortVlanWidget from being
@@ -176,24 +308,30 @@ class PortVlanWidget(urwid.Widget):
 
     def render(self, size, focus=False):
         cols, = size
-        text = " " * ((cols - 2) // 2)
         member = self.vlan.ports[self.port]
         if member == Vlan.TAGGED:
-            text += "TT"
             attr = "tagged"
         elif member == Vlan.UNTAGGED:
-            text += "UU"
             attr = "untagged"
         else:
             assert member == Vlan.NOTMEMBER
             attr = "none"
-            text += "  "
         if focus:
             attr += "_focus"
+        elif self.matrix.is_selected(self.port, self.vlan):
+            attr += "_selected"
 
-        text += " " * (cols - 2 - ((cols - 2) // 2))
+        canvas = self.canvas_cache.get((attr, cols))
+        if canvas is None:
+            text = " " * ((cols - 2) // 2)
+            text += {Vlan.TAGGED: "TT", Vlan.UNTAGGED: "UU", Vlan.NOTMEMBER: "  "}[member]
+            text += " " * (cols - 2 - ((cols - 2) // 2))
+            canvas = urwid.TextCanvas([text.encode()], [[(attr, len(text))]])
+            self.canvas_cache[attr, cols] = canvas
 
-        return urwid.TextCanvas([text.encode()], [[(attr, len(text))]])
+        # urwid marks the canvas returned with the widget it belongs
+        # to, so return a (cheap) canvas that refers to the shared one
+        return urwid.CompositeCanvas(canvas)
 
     def rows(self, size, focus=False):
         return 1
@@ -223,6 +361,58 @@ class PortWidget(urwid.Text):
         return key
 
 
+class ChangeList(urwid.BoxAdapter):
+    """
+    Displays a list of changes, one Text widget per change, in a
+    scrollable ListBox of at most max_rows rows. On updates, widgets
+    are only created for changes that were added or replaced (by
+    merging), and only the visible ones are laid out.
+    """
+    def __init__(self, max_rows):
+        self.max_rows = max_rows
+        self.changes = []
+        self.walker = urwid.SimpleFocusListWalker([urwid.Text("No changes")])
+        super(ChangeList, self).__init__(urwid.ListBox(self.walker), 1)
+
+    def set_changes(self, changes):
+        old = self.changes
+        self.changes = list(changes)
+
+        if not old or not changes:
+            widgets = [self.change_widget(c) for c in changes] or [urwid.Text("No changes")]
+            self.walker[:] = widgets
+        else:
+            # Changes are usually appended, or replaced or removed in
+            # place when merged, so find the part that differs
+            start = 0
+            while start < min(len(old), len(changes)) and old[start] is changes[start]:
+                start += 1
+            end = 0
+            while end < min(len(old), len(changes)) - start and old[-1 - end] is changes[-1 - end]:
+                end += 1
+            # Changes in between that were kept keep their widget
+            widgets = dict(zip(old[start:len(old) - end], self.walker[start:len(old) - end]))
+            self.walker[start:len(old) - end] = [
+                widgets.get(c) or self.change_widget(c) for c in changes[start:len(changes) - end]]
+
+        self.height = max(1, min(len(changes), self.max_rows))
+        self._invalidate()
+
+    def change_widget(self, change):
+        return urwid.AttrMap(SelectableText(str(change)), None, 'focus')
+
+
+class SelectableText(urwid.Text):
+    """
+    Text widget that can be focused, e.g. to scroll through a ListBox of
+    them.
+    """
+    _selectable = True
+
+    def keypress(self, size, key):
+        return key
+
+
 class TopLine(urwid.LineBox):
     """
     A box like LineBox, but containing just the top line